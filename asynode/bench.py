@@ -0,0 +1,196 @@
+""" Benchmarks for asynode components.
+
+Run a benchmark by name from the package directory::
+
+    $ python bench.py spool -n 1000000
+"""
+import os
+import time
+import shutil
+import tempfile
+from optparse import OptionParser
+
+BENCHMARKS = {}
+
+def benchmark(func):
+    BENCHMARKS[func.__name__] = func
+    return func
+
+def report(name, count, elapsed):
+    print('{0:<24} {1:>10} ops {2:>9.3f}s {3:>12.0f} ops/s'.format(
+        name, count, elapsed, count / elapsed if elapsed else 0
+    ))
+
+@benchmark
+def spool(options):
+    """ Enqueue throughput and recovery time of :class:`spool.Spool`. """
+    from spool import Spool
+    path = tempfile.mkdtemp(dir=options.dir)
+    try:
+        message = 'x' * options.size
+        queue = Spool(path, batch=options.batch)
+        start = time.time()
+        for _ in range(options.number):
+            queue.enqueue('localhost', 25,
+                source='me@work.it', targets=['you@work.it'], message=message,
+                localname='localhost',
+            )
+        queue.commit()
+        report('spool.enqueue', options.number, time.time() - start)
+        queue.close()
+        start = time.time()
+        queue = Spool(path)
+        recovered = sum(1 for _ in queue.pending())
+        report('spool.recover', recovered, time.time() - start)
+        queue.close()
+    finally:
+        shutil.rmtree(path)
+
+@benchmark
+def accept(options):
+    """ Connections accepted per second by an SMTP factory, with and without
+    a shared :class:`smtp.SMTPContext`.
+    """
+    import socket
+    import asyncore
+    from core import ConnectionFactory
+    from smtp import SMTPIncomingAutomaton, SMTPContext
+    for name, context in (('private', None), ('shared', SMTPContext())):
+        factory = ConnectionFactory(SMTPIncomingAutomaton, None, context=context)
+        pairs = [socket.socketpair() for _ in range(min(options.number, 256))]
+        start = time.time()
+        for index in range(options.number):
+            factory.accept(pairs[index % len(pairs)][0])
+            asyncore.socket_map.clear()
+        report('accept.' + name, options.number, time.time() - start)
+        for pair in pairs:
+            pair[0].close()
+            pair[1].close()
+
+@benchmark
+def replay(options):
+    """ Automaton cost of replaying SMTP sessions in-process. With
+    ``--transcript`` a recorded transcript is replayed instead of a
+    synthetic one.
+    """
+    from replay import Recorder, OPEN, RECV, replay as run_replay
+    from smtp import SMTPIncomingAutomaton, SMTPContext
+    context = SMTPContext(fqdn='localhost')
+    name = 'smtp.SMTPIncomingAutomaton'
+    automatons = {name: lambda: SMTPIncomingAutomaton(context=context)}
+    path = options.transcript
+    if path is None:
+        path = tempfile.mktemp(dir=options.dir)
+        recorder = Recorder(path)
+        session = [
+            'HELO client\r\n', 'MAIL FROM: <me@work.it>\r\n',
+            'RCPT TO: <you@work.it>\r\n', 'DATA\r\n',
+            'x' * options.size + '\r\n.\r\n', 'QUIT\r\n',
+        ]
+        for cid in range(options.number):
+            recorder.write(cid, OPEN, name, 0)
+            for data in session:
+                recorder.write(cid, RECV, data, 0)
+        recorder.close()
+    try:
+        start = time.time()
+        players = run_replay(path, automatons)
+        report('replay.smtp', len(players), time.time() - start)
+    finally:
+        if options.transcript is None:
+            os.remove(path)
+
+def transfer(name, options, instate, outstate, host, port, **kwargs):
+    """ Deliver ``--number`` messages of ``--size`` bytes one after the
+    other to a node listening on host:port and report the rate.
+    """
+    import asyncore
+    from core import ConnectionFactory
+    from smtp import SMTPContext
+    message = ('x' * 78 + '\n') * (options.size // 79 + 1)
+    factory = ConnectionFactory(instate, outstate,
+        context=SMTPContext(fqdn='localhost', maxsize=2 * len(message)),
+    )
+    listener = factory.listen(host, port)
+    if port is not None:
+        port = listener.socket.getsockname()[1]
+    start = time.time()
+    for _ in range(options.number):
+        factory.send(host, port,
+            source='me@work.it', targets=['you@work.it'], message=message,
+            localname='localhost', **kwargs
+        )
+        while len(asyncore.socket_map) > 1:
+            asyncore.loop(0.1, count=1)
+    listener.close()
+    report(name, options.number, time.time() - start)
+
+@benchmark
+def chunking(options):
+    """ SMTP delivery over loopback with ``DATA`` and with ``BDAT`` chunks. """
+    from smtp import SMTPIncomingAutomaton, SMTPOutcomingAutomaton
+    for name, esmtp in (('data', False), ('bdat', True)):
+        transfer('chunking.' + name, options,
+            SMTPIncomingAutomaton, SMTPOutcomingAutomaton,
+            '127.0.0.1', 0, esmtp=esmtp,
+        )
+
+@benchmark
+def transport(options):
+    """ LMTP delivery over TCP loopback and over a Unix socket. """
+    from lmtp import LMTPIncomingAutomaton, LMTPOutcomingAutomaton
+    path = tempfile.mkdtemp(dir=options.dir)
+    try:
+        for name, host, port in (
+            ('tcp', '127.0.0.1', 0),
+            ('unix', os.path.join(path, 'lmtp.sock'), None),
+        ):
+            transfer('transport.' + name, options,
+                LMTPIncomingAutomaton, LMTPOutcomingAutomaton, host, port,
+            )
+    finally:
+        shutil.rmtree(path)
+
+def main():
+    parser = OptionParser(
+        usage='%prog [options] {0}'.format('|'.join(sorted(BENCHMARKS)))
+    )
+    parser.add_option('-n', '--number',
+        action  = 'store',
+        dest    = 'number',
+        type    = 'int',
+        help    = 'Number of operations [1000000]',
+        default = 1000000,
+    )
+    parser.add_option('-s', '--size',
+        action  = 'store',
+        dest    = 'size',
+        type    = 'int',
+        help    = 'Message size in bytes [1024]',
+        default = 1024,
+    )
+    parser.add_option('-b', '--batch',
+        action  = 'store',
+        dest    = 'batch',
+        type    = 'int',
+        help    = 'Messages per fsync [1024]',
+        default = 1024,
+    )
+    parser.add_option('-t', '--transcript',
+        action  = 'store',
+        dest    = 'transcript',
+        help    = 'Transcript to replay [synthetic]',
+        default = None,
+    )
+    parser.add_option('-d', '--dir',
+        action  = 'store',
+        dest    = 'dir',
+        help    = 'Working directory [system temporary directory]',
+        default = None,
+    )
+    options, args = parser.parse_args()
+    for name in args or sorted(BENCHMARKS):
+        BENCHMARKS[name](options)
+
+if __name__ == '__main__':
+    main()
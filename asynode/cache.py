@@ -0,0 +1,73 @@
+""" Small in-process caches shared by asynode components. """
+import time
+from collections import OrderedDict
+
+__all__ = (
+    'TTLCache',
+)
+
+class TTLCache(object):
+    """ A bounded mapping whose entries expire after a time-to-live.
+    When full, the least recently used entry is evicted.
+
+    :param maxsize: maximum number of entries.
+    :type maxsize: :class:`int`
+    :param ttl: default time-to-live in seconds.
+    :type ttl: :class:`float`
+    :param clock: callable returning the current time.
+
+    >>> now = [0]
+    >>> c = TTLCache(maxsize=2, ttl=10, clock=lambda: now[0])
+    >>> c.set('a', 1); c.set('b', 2, ttl=1)
+    >>> c.get('a'), c.get('b')
+    (1, 2)
+    >>> now[0] = 5
+    >>> c.get('b', 'expired'), 'b' in c
+    ('expired', False)
+    >>> c.set('c', 3); c.set('d', 4)
+    >>> c.get('a'), len(c)
+    (None, 2)
+    """
+    def __init__(self, maxsize=1024, ttl=300, clock=time.time):
+        " Initialize a new :class:`TTLCache`"
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        """ Return the value for ``key`` if cached and still fresh. """
+        try:
+            expires, value = self._data.pop(key)
+        except KeyError:
+            return default
+        if expires <= self.clock():
+            return default
+        self._data[key] = expires, value
+        return value
+
+    def set(self, key, value, ttl=None):
+        """ Cache ``value`` under ``key`` for ``ttl`` seconds (default
+        :attr:`ttl`).
+        """
+        ttl = self.ttl if ttl is None else ttl
+        self._data.pop(key, None)
+        if ttl <= 0:
+            return
+        while len(self._data) >= self.maxsize:
+            self._data.popitem(last=False)
+        self._data[key] = self.clock() + ttl, value
+
+    def discard(self, key):
+        """ Drop ``key`` from the cache, if present. """
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key):
+        missing = object()
+        return self.get(key, missing) is not missing
+
+    def __len__(self):
+        return len(self._data)
@@ -5,46 +5,107 @@ and a factory :class:`ConnectionFactory` to link connections and break point
 handlers. The term ``break point``  is intended to indicate a point in the
 protocol execution you need to interpret an event.
 """
+import os
+import stat
+import errno
 import asyncore
 import asynchat
 import socket
 import logging
+from loop import call_later, call_soon_threadsafe, waker
+from futures import TimeoutError
+from replay import OPEN, CONNECT, RECV, SEND, CLOSE
 LOGGER = logging.getLogger('asynode')
 
 __all__ = (
     'BaseServerd',
     'Connection',
     'ConnectionFactory',
+    'Race',
 )
 
+def sockaddr(host, port):
+    r""" Return the address family and the socket address of an endpoint.
+    When ``port`` is ``None``, ``host`` is the path of a Unix socket, in the
+    Linux abstract namespace if it starts with ``@``.
+
+    >>> sockaddr('/var/run/asynode.sock', None) == (socket.AF_UNIX, '/var/run/asynode.sock')
+    True
+    >>> sockaddr('@asynode', None)[1]
+    '\x00asynode'
+    >>> sockaddr('::1', 25) == (socket.AF_INET6, ('::1', 25))
+    True
+    """
+    if port is None:
+        if host.startswith('@'):
+            host = '\0' + host[1:]
+        return socket.AF_UNIX, host
+    if ':' in host:
+        return socket.AF_INET6, (host, port)
+    return socket.AF_INET, (host, port)
+
+def unlink_stale(path):
+    """ Remove the Unix socket at ``path`` if nothing listens on it anymore. """
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return
+    except OSError:
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except socket.error as e:
+        if e.errno == errno.ECONNREFUSED:
+            LOGGER.info('Removing stale socket {0}'.format(path))
+            os.unlink(path)
+    finally:
+        probe.close()
+
+
 class BaseServerd(asyncore.dispatcher):
     """ This class is responsible for managing incoming event.
     On an incoming event, it calls back ``on_accept`` function passed during its
     initialization.
 
-    :param host: network host name or ip.
+    :param host: network host name or ip, or the path of a Unix socket.
     :type host: :class:`str`
-    :param port: listening port.
+    :param port: listening port, ``None`` for a Unix socket (see
+        :func:`sockaddr`).
     :type port: :class:`int`
     :param on_accept: callback function called on accept event.
     :type on_accept: callable
+    :param sock: an already listening socket, e.g. inherited from another
+        process, used instead of binding a new one.
+    :type sock: :class:`socket`
 
     .. note:: ``on_accept`` have to *accept* a :class:`socket` as input
         parameter.
     """
-    def __init__ (self, host, port, on_accept):
+    def __init__ (self, host, port, on_accept, sock=None):
         " Initialize and bind an Event Listener."
-        asyncore.dispatcher.__init__ (self)
+        asyncore.dispatcher.__init__ (self, sock)
         self.on_accept = on_accept
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.set_reuse_addr()
-        self.bind((host, port))
-        self.listen(5)
-        LOGGER.info('Listening on {h}:{p}'.format(h=host, p=port))
+        if sock is None:
+            family, address = sockaddr(host, port)
+            self.create_socket(family, socket.SOCK_STREAM)
+            if family == socket.AF_UNIX:
+                if not address.startswith('\0'):
+                    unlink_stale(address)
+            else:
+                self.set_reuse_addr()
+            self.bind(address)
+            self.listen(5)
+        else:
+            self.accepting = True
+        if port is None:
+            LOGGER.info('Listening on {h}'.format(h=host))
+        else:
+            LOGGER.info('Listening on {h}:{p}'.format(h=host, p=port))
 
     def handle_accept(self):
-        sock, _ = self.accept()
-        self.on_accept(sock)
+        pair = self.accept()
+        if pair is not None:
+            self.on_accept(pair[0])
 
 
 class Connection(asynchat.async_chat):
@@ -63,6 +124,104 @@ class Connection(asynchat.async_chat):
     +------------------------+-----------------+
     | ``found_terminator()`` | ``OPERATIVE``   |
     +------------------------+-----------------+
+    | ``push()``             | ``PAUSE``       |
+    +------------------------+-----------------+
+    | ``handle_write()``     | ``RESUME``      |
+    +------------------------+-----------------+
+    | ``handle_close()``     | ``CLOSED``      |
+    +------------------------+-----------------+
+
+    When more than :attr:`high_watermark` bytes are waiting to be sent, the
+    connection stops reading and calls the ``PAUSE`` break point; once the
+    output drains below :attr:`low_watermark`, it calls ``RESUME`` and
+    reads again. :attr:`outgoing` and :attr:`incoming_bytes` count the
+    buffered bytes.
+
+    >>> from state import State, Automaton
+    >>> class Flow(Automaton):
+    ...     def __init__(self):
+    ...         self.events = []
+    ...     def initial(self, data):
+    ...         return State.get_push(terminator='\\r\\n')
+    ...     def pause(self, data):
+    ...         self.events.append('PAUSE')
+    ...         return State.get_push()
+    ...     def resume(self, data):
+    ...         self.events.append('RESUME')
+    ...         return State.get_push()
+    >>> a, b = socket.socketpair()
+    >>> flow = Flow()
+    >>> conn = Connection(flow, a)
+    >>> b.sendall('partial')
+    >>> conn.handle_read(); conn.incoming_bytes
+    7
+    >>> conn.push('x' * 1024 * 1024)
+    >>> flow.events, conn.readable(), conn.outgoing > conn.high_watermark
+    (['PAUSE'], False, True)
+    >>> while flow.events[-1] != 'RESUME':
+    ...     _ = b.recv(65536); conn.handle_write()
+    >>> bool(conn.readable()), conn.outgoing <= conn.low_watermark
+    (True, True)
+    >>> conn.close(); b.close()
+
+    A break point can also return a future of its :class:`state.State`
+    (see :mod:`futures`): reading stops until it resolves. A future not
+    resolved within :attr:`wait_timeout` seconds calls ``ERROR``:
+
+    >>> from futures import Future
+    >>> from loop import run
+    >>> from state import Automaton
+    >>> class Stuck(Automaton):
+    ...     def initial(self, data):
+    ...         return Future()
+    >>> class ImpatientConnection(Connection):
+    ...     wait_timeout = 0.01
+    >>> a, b = socket.socketpair()
+    >>> conn = ImpatientConnection(Stuck(), a)
+    >>> run(0.1)
+    >>> conn.connected
+    False
+    >>> b.close()
+
+    A future resolving to something else than a state calls ``ERROR`` on
+    its own connection only:
+
+    >>> from loop import call_later
+    >>> from state import State
+    >>> class Later(Automaton):
+    ...     def __init__(self, state):
+    ...         self.state = state
+    ...     def initial(self, data):
+    ...         future = Future()
+    ...         call_later(0, future.set_result, self.state)
+    ...         return future
+    >>> a, b = socket.socketpair()
+    >>> c, d = socket.socketpair()
+    >>> broken = Connection(Later(None), a)
+    >>> fine = Connection(Later(State.get_final('hi\\r\\n', close=True)), c)
+    >>> run(0.1)
+    >>> broken.connected, d.recv(16)
+    (False, 'hi\\r\\n')
+    >>> b.close(); d.close()
+
+    Input waiting for a string terminator is bounded by :attr:`maxline`
+    bytes, input waiting for an integer or ``None`` terminator by
+    :attr:`maxbuffer` bytes, unless the :class:`state.State` setting the
+    terminator overrides them. On overflow the buffered data is dropped, the
+    ``ERROR`` break point is called with ``None`` and input is discarded up
+    to the next terminator. A connection thus never holds more than its
+    limit plus ``ac_in_buffer_size`` bytes of input.
+
+    >>> from echo import EchoIncomingAutomaton
+    >>> class SmallConnection(Connection):
+    ...     maxline = 1024
+    >>> a, b = socket.socketpair()
+    >>> conn = SmallConnection(EchoIncomingAutomaton(), a)
+    >>> b.sendall('x' * 4096)
+    >>> conn.handle_read(); conn.handle_write()
+    >>> conn.connected, b.recv(16)
+    (False, '')
+    >>> b.close()
 
     .. note::
         Only in **CLIENT MODE** we have to handle a connection.
@@ -71,26 +230,60 @@ class Connection(asynchat.async_chat):
     :type automaton: :class:`state.Automaton`
     :param sock: an initialized `socket` [**SERVER MODE**] or nothing [**CLIENT MODE**].
     :type sock: :class:`socket`
+    :param family: address family of the socket created in **CLIENT MODE**.
 
     .. note::
         `callback` function will be called with
         *state, inbuffer, cid and a callback*
 
     .. warning:: Probably you wouldn't subclass it.
+
+    Set :attr:`recorder` to a :class:`replay.Recorder` to capture wire
+    transcripts of every connection.
     """
-    def __init__(self, automaton, sock=None):
+    recorder = None
+    high_watermark = 64 * 1024
+    low_watermark = 16 * 1024
+    maxline = 64 * 1024
+    maxbuffer = 1024 * 1024
+    ac_in_buffer_size = 64 * 1024
+    ac_out_buffer_size = 64 * 1024
+    wait_timeout = None
+
+    def __init__(self, automaton, sock=None, family=socket.AF_INET):
         " Initilize a new :class:`Connection`"
-        sock = sock or socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock = sock or socket.socket(family, socket.SOCK_STREAM)
         asynchat.async_chat.__init__(self, sock)
+        self.set_terminator(None)
         self.automaton = automaton
         self._buffer = []
+        self._waiting = None
+        self._wait_timer = None
+        self._held = []
+        self._throttled = False
+        self._buffered = 0
+        self._overflow = False
+        self._maxline = self.maxline
+        self._maxbuffer = self.maxbuffer
+        self.outgoing = 0
         if self.addr:
             LOGGER.info('Incoming connection from {s.addr}'.format(s=self))
+        if self.recorder is not None:
+            self.recorder.record(self, OPEN)
         self.process('INITIAL', self._buffer)
 
     def process(self, state, data):
         """ Process a break point """
-        next_state = self.automaton.next(''.join(data), state)
+        next_state = self.automaton.next(
+            None if data is None else ''.join(data), state
+        )
+        if hasattr(next_state, 'add_done_callback'):
+            self.wait(next_state)
+        else:
+            self.apply(next_state)
+
+    def apply(self, next_state):
+        """ Apply the :class:`state.State` returned by a break point. """
         data = next_state.push
         terminator = next_state.terminator
         close = next_state.close
@@ -98,6 +291,12 @@ class Connection(asynchat.async_chat):
         if terminator is not None:
             LOGGER.debug('Setting terminator to {t!r}'.format(t=terminator))
             self.set_terminator(terminator)
+            self._maxline = self.maxline
+            self._maxbuffer = self.maxbuffer
+            if next_state.maxline is not None:
+                self._maxline = next_state.maxline
+            if next_state.maxbuffer is not None:
+                self._maxbuffer = next_state.maxbuffer
         if data is not None:
             logd = data.strip() or '<QUIT>'
             LOGGER.info('{s.local} => {s.remote}: {d!r}'.format(s=self, d=logd))
@@ -105,32 +304,160 @@ class Connection(asynchat.async_chat):
         if close:
             self.close_when_done()
 
+    def recv(self, buffer_size):
+        data = asynchat.async_chat.recv(self, buffer_size)
+        if self.recorder is not None and data:
+            self.recorder.record(self, RECV, data)
+        return data
+
+    def push(self, data):
+        if self.recorder is not None:
+            self.recorder.record(self, SEND, data)
+        self.outgoing += len(data)
+        asynchat.async_chat.push(self, data)
+        if self.outgoing > self.high_watermark and not self._throttled:
+            LOGGER.debug('Pausing {s.remote}: {s.outgoing} bytes buffered'.format(s=self))
+            self._throttled = True
+            self.process('PAUSE', [])
+
+    def send(self, data):
+        sent = asynchat.async_chat.send(self, data)
+        self.outgoing -= sent
+        return sent
+
+    def handle_write(self):
+        asynchat.async_chat.handle_write(self)
+        if self._throttled and self.outgoing <= self.low_watermark:
+            LOGGER.debug('Resuming {s.remote}'.format(s=self))
+            self._throttled = False
+            self.process('RESUME', [])
+
+    @property
+    def incoming_bytes(self):
+        """ Bytes read and not yet processed by a break point. """
+        return (
+            sum(len(d) for d in self._buffer) + len(self.ac_in_buffer)
+            + sum(len(d) for d in self._held)
+        )
+
+    def wait(self, future):
+        """ Stop reading until ``future`` resolves to the next
+        :class:`state.State`. Data already read is held until then.
+        """
+        LOGGER.debug('Waiting on {f!r}'.format(f=future))
+        lookahead = getattr(future, 'lookahead', None)
+        if lookahead is not None:
+            lookahead(self.ac_in_buffer)
+        waker()
+        self._waiting = future
+        self._terminator = self.get_terminator()
+        self.set_terminator(None)
+        if self.wait_timeout is not None:
+            self._wait_timer = call_later(
+                self.wait_timeout, self._resume, future, True
+            )
+        future.add_done_callback(
+            lambda f: call_soon_threadsafe(self._resume, f)
+        )
+
+    def _resume(self, future, expired=False):
+        if self._waiting is not future:
+            return
+        self._waiting = None
+        if self._wait_timer is not None:
+            self._wait_timer.cancel()
+            self._wait_timer = None
+        self.set_terminator(self._terminator)
+        try:
+            if expired:
+                raise TimeoutError('No state after {0}s'.format(
+                    self.wait_timeout
+                ))
+            self.apply(future.result())
+        except Exception:
+            self.handle_error()
+        held, self._held = ''.join(self._held), []
+        if held and self.connected:
+            self.recv = lambda buffer_size: held
+            try:
+                asynchat.async_chat.handle_read(self)
+            finally:
+                del self.recv
+
+    def readable(self):
+        return (
+            self._waiting is None and not self._throttled
+            and asynchat.async_chat.readable(self)
+        )
+
     def collect_incoming_data(self, data):
+        if self._waiting is not None:
+            self._held.append(data)
+            return
+        if self._overflow:
+            return
         LOGGER.info('{s.local} <= {s.remote}: {d!r}'.format(s=self, d=data))
+        self._buffered += len(data)
+        if isinstance(self.get_terminator(), basestring):
+            limit = self._maxline
+        else:
+            limit = self._maxbuffer
+        if self._buffered > limit:
+            LOGGER.warning('{s.remote} exceeded {l} buffered bytes'.format(
+                s=self, l=limit
+            ))
+            self._buffer = []
+            self._buffered = 0
+            self._overflow = True
+            self.process('ERROR', None)
+            return
         self._buffer.append(data)
 
     def handle_connect(self):
         LOGGER.info('Connected to {s.remote}'.format(s=self))
+        if self.recorder is not None:
+            self.recorder.record(self, CONNECT)
         self.process('OPERATIVE', self._buffer)
 
     def found_terminator(self):
+        if self._overflow:
+            self._overflow = False
+            return
         if not self._buffer:
             self.handle_close()
         self.process('OPERATIVE', self._buffer)
         self._buffer = []
+        self._buffered = 0
 
     def handle_close(self):
         LOGGER.info('Closing {s.remote}'.format(s=self))
+        self.process('CLOSED', self._buffer)
+        self._buffer = []
+        self._buffered = 0
         asynchat.async_chat.handle_close(self)
 
+    def close(self):
+        if self.recorder is not None:
+            self.recorder.record(self, CLOSE)
+        self._waiting = None
+        if self._wait_timer is not None:
+            self._wait_timer.cancel()
+            self._wait_timer = None
+        asynchat.async_chat.close(self)
+
     def handle_error(self):
-        LOGGER.error('Handling connection error')
-        self.process('ERROR', self._buffer)
+        LOGGER.exception('Handling connection error')
+        try:
+            self.process('ERROR', self._buffer)
+        except Exception:
+            LOGGER.exception('ERROR break point failed, closing')
+            self.close()
 
     @property
     def remote(self):
         """ Return the address of the remote endpoint.
-        For IP sockets, the address info is a pair (hostaddr, port).
+        For IP sockets, the address info is a pair (hostaddr, port), for Unix
+        sockets a path, empty when the peer is not bound.
         """
         try:
             return self.socket.getpeername()
@@ -141,11 +468,168 @@ class Connection(asynchat.async_chat):
     @property
     def local(self):
         """ Return the address of the local endpoint.
-        For IP sockets, the address info is a pair (hostaddr, port).
+        For IP sockets, the address info is a pair (hostaddr, port), for Unix
+        sockets a path.
         """
         return self.socket.getsockname()
 
 
+class ConnectAttempt(asyncore.dispatcher):
+    """ A bare non-blocking connect to one endpoint of a :class:`Race`,
+    failed after ``timeout`` seconds.
+    """
+    def __init__(self, race, endpoint, timeout=None):
+        asyncore.dispatcher.__init__(self)
+        self.race = race
+        self.endpoint = endpoint
+        self.timer = None
+        family, address = sockaddr(*endpoint)
+        self.create_socket(family, socket.SOCK_STREAM)
+        try:
+            self.connect(address)
+        except socket.error:
+            self.close()
+            raise
+        if timeout is not None and not self.connected:
+            self.timer = call_later(timeout, self.race.failed, self)
+
+    def cancel_timeout(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def readable(self):
+        return False
+
+    def handle_connect(self):
+        self.cancel_timeout()
+        self.race.won(self)
+
+    def handle_close(self):
+        self.race.failed(self)
+
+    def handle_error(self):
+        LOGGER.exception('Connection attempt to {0} failed'.format(
+            self.endpoint
+        ))
+        self.race.failed(self)
+
+    def close(self):
+        self.cancel_timeout()
+        asyncore.dispatcher.close(self)
+
+
+class Race(object):
+    """ Connect to the first reachable endpoint of a prioritized list,
+    Happy Eyeballs style: a new attempt starts every ``stagger`` seconds (or
+    as soon as the previous one fails) while earlier ones are still pending.
+    The first attempt to connect wins and the others are closed.
+
+    :param endpoints: prioritized ``(host, port)`` endpoints, see
+        :func:`sockaddr`.
+    :type endpoints: :class:`list`
+    :param on_connect: called with the winning connected :class:`socket`.
+    :type on_connect: callable
+    :param on_fail: called without arguments when every attempt failed.
+    :type on_fail: callable
+    :param stagger: delay in seconds between attempts.
+    :type stagger: :class:`float`
+    :param timeout: seconds after which a pending attempt fails.
+    :type timeout: :class:`float`
+
+    >>> from loop import run
+    >>> listener = socket.socket()
+    >>> listener.bind(('127.0.0.1', 0)); listener.listen(1)
+    >>> closed = socket.socket(); closed.bind(('127.0.0.1', 0))
+    >>> refused = closed.getsockname(); closed.close()
+    >>> won, failed = [], []
+    >>> race = Race([refused, listener.getsockname()], won.append,
+    ...     lambda: failed.append(True), stagger=1)
+    >>> run(0.01)
+    >>> won[0].getpeername() == listener.getsockname(), failed
+    (True, [])
+    >>> won[0].close()
+    >>> race = Race([refused], won.append, lambda: failed.append(True))
+    >>> run(0.01)
+    >>> len(won), failed
+    (1, [True])
+
+    Errors of ``on_connect`` are logged, not mistaken for a lost race:
+
+    >>> def broken(sock):
+    ...     raise ValueError('broken handler')
+    >>> race = Race([listener.getsockname()], broken,
+    ...     lambda: failed.append(True))
+    >>> run(0.01)
+    >>> failed
+    [True]
+    >>> listener.close()
+    """
+    def __init__(self, endpoints, on_connect, on_fail=None, stagger=0.25,
+            timeout=30.0):
+        " Initilize a new :class:`Race` and start the first attempt"
+        self.pending = list(endpoints)
+        self.on_connect = on_connect
+        self.on_fail = on_fail
+        self.stagger = stagger
+        self.timeout = timeout
+        self.attempts = []
+        self.timer = None
+        self.attempt()
+
+    def attempt(self):
+        """ Start a connection attempt to the next endpoint. """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        while self.pending:
+            endpoint = self.pending.pop(0)
+            try:
+                self.attempts.append(
+                    ConnectAttempt(self, endpoint, self.timeout)
+                )
+            except socket.error as e:
+                LOGGER.warning('Cannot connect to {0}: {1}'.format(endpoint, e))
+                continue
+            LOGGER.debug('Connecting to {0}'.format(endpoint))
+            if self.pending:
+                self.timer = call_later(self.stagger, self.attempt)
+            return
+        if not self.attempts:
+            LOGGER.error('No endpoint reachable')
+            if self.on_fail is not None:
+                self.on_fail()
+
+    def won(self, winner):
+        """ Keep the socket of ``winner`` and close every other attempt. """
+        if self.timer is not None:
+            self.timer.cancel()
+        self.pending = []
+        for attempt in self.attempts:
+            if attempt is not winner:
+                attempt.close()
+        self.attempts = []
+        winner.del_channel()
+        LOGGER.debug('Race won by {0}'.format(winner.endpoint))
+        try:
+            self.on_connect(winner.socket)
+        except Exception:
+            LOGGER.exception('Connect handler failed for {0}'.format(
+                winner.endpoint
+            ))
+
+    def failed(self, attempt):
+        """ Drop ``attempt`` and start the next one right away. Attempts no
+        longer racing, like the winner, are left alone.
+        """
+        if attempt not in self.attempts:
+            return
+        LOGGER.warning('Connection to {0} failed'.format(attempt.endpoint))
+        attempt.close()
+        self.attempts.remove(attempt)
+        self.attempt()
+
+
 class ConnectionFactory(object):
     """ This class helps to create connections and manage their break points
     binding connections and their break points handlers.
@@ -154,6 +638,19 @@ class ConnectionFactory(object):
     :type instate: :class:`Automaton`
     :param outstate: Outcoming connection break point handler.
     :type outstate: :class:`Automaton`
+    :param resolver: resolver used by :meth:`deliver` (default a new
+        :class:`resolver.Resolver`).
+    :type resolver: :class:`resolver.Resolver`
+    :param stagger: delay in seconds between connection attempts when
+        racing several endpoints.
+    :type stagger: :class:`float`
+    :param timeout: seconds after which a raced connection attempt fails.
+    :type timeout: :class:`float`
+    :param handoff: hands listening sockets over between processes on a
+        graceful reload.
+    :type handoff: :class:`handoff.Handoff`
+    :param context: precomputed state passed as ``context`` to every
+        incoming break point handler, e.g. a :class:`smtp.SMTPContext`.
     """
     def __init__(self, instate, outstate, **kwargs):
         " Initilize a new :class:`ConnectionFactory`"
@@ -163,13 +660,32 @@ class ConnectionFactory(object):
         self.incoming   = kwargs.get('inconn', Connection)
         self.outcoming  = kwargs.get('outconn', Connection)
         self.collect    = kwargs.get('collect', lambda x: x)
+        self._resolver  = kwargs.get('resolver')
+        self.stagger    = kwargs.get('stagger', 0.25)
+        self.timeout    = kwargs.get('timeout', 30.0)
+        self.handoff    = kwargs.get('handoff')
+        self.context    = kwargs.get('context')
+
+    @property
+    def resolver(self):
+        if self._resolver is None:
+            from resolver import Resolver
+            self._resolver = Resolver()
+        return self._resolver
 
     def listen(self, host, port, on_accept=None):
         """ Create a listener (default :class:`BaseServerd`) bound on
-        host:port.
+        host:port, or on the Unix socket ``host`` when ``port`` is ``None``.
+        With a ``handoff``, the listening socket of the previous process is
+        reused when available.
         """
         on_accept = on_accept or self.accept
-        self.listener(host, port, on_accept)
+        if self.handoff is None:
+            return self.listener(host, port, on_accept)
+        sock = self.handoff.take(host, port)
+        listener = self.listener(host, port, on_accept, sock=sock)
+        self.handoff.register(listener)
+        return listener
 
     def accept(self, sock):
         """ Create an incoming connection (default :class:`Connection`) and its
@@ -177,13 +693,72 @@ class ConnectionFactory(object):
 
         .. note:: Usually called after a listener's accept.
         """
-        conn = self.incoming(self.instate(), sock)
+        if self.context is None:
+            automaton = self.instate()
+        else:
+            automaton = self.instate(context=self.context)
+        conn = self.incoming(automaton, sock)
         self.collect(conn)
 
     def send(self, host, port, *args, **kwargs):
         """ Create and connect an outcoming connection (default
-        :class:`Connection`) and its break point handler.
+        :class:`Connection`) and its break point handler. With ``port``
+        ``None``, ``host`` is the path of a Unix socket.
+
+        ``host`` can also be a prioritized list of hosts or ``(host, port)``
+        endpoints: they are raced with a :class:`Race` and only the winning
+        socket is bound to the break point handler. When none is reachable,
+        the ``ERROR`` break point is called, as for a single host.
+        """
+        self.connect(self.outstate(*args, **kwargs), host, port)
+
+    def connect(self, automaton, host, port=None):
+        """ Connect an outcoming connection driven by ``automaton``. See
+        :meth:`send` for ``host`` and ``port``.
         """
-        conn = self.outcoming(self.outstate(*args, **kwargs))
+        if isinstance(host, (list, tuple)):
+            endpoints = [
+                e if isinstance(e, tuple) else (e, port) for e in host
+            ]
+            def on_connect(sock):
+                conn = self.outcoming(automaton, sock)
+                self.collect(conn)
+                try:
+                    conn.handle_connect()
+                except Exception:
+                    conn.handle_error()
+            def on_fail():
+                automaton.next('', 'ERROR')
+            Race(endpoints, on_connect, on_fail, self.stagger, self.timeout)
+            return
+        family, address = sockaddr(host, port)
+        conn = self.outcoming(automaton, family=family)
         self.collect(conn)
-        conn.connect((host, port))
+        conn.connect(address)
+
+    def deliver(self, domain, port, *args, **kwargs):
+        """ Like :meth:`send`, but towards the mail exchanger of ``domain``.
+        ``MX``, ``A`` and ``AAAA`` records are resolved without blocking the
+        loop and every resolved address is raced. When ``domain`` cannot be
+        resolved, the ``ERROR`` break point is called.
+
+        >>> from state import Automaton
+        >>> from resolver import DNSError
+        >>> class Unresolvable(object):
+        ...     def resolve_endpoints(self, domain, port, callback):
+        ...         callback(None, DNSError('{0} does not exist'.format(domain)))
+        >>> class Undeliverable(Automaton):
+        ...     def error(self, data):
+        ...         print('ERROR')
+        >>> node = ConnectionFactory(None, Undeliverable, resolver=Unresolvable())
+        >>> node.deliver('nowhere.invalid', 25)
+        ERROR
+        """
+        automaton = self.outstate(*args, **kwargs)
+        def on_endpoints(endpoints, error):
+            if error is not None:
+                LOGGER.error('Cannot deliver to {d}: {e}'.format(d=domain, e=error))
+                automaton.next('', 'ERROR')
+                return
+            self.connect(automaton, endpoints, port)
+        self.resolver.resolve_endpoints(domain, port, on_endpoints)
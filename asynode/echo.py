@@ -30,13 +30,14 @@ class EchoIncomingAutomaton(Automaton):
 if __name__ == '__main__':
     import logging
     logging.basicConfig(level=logging.INFO)
-    from opt import parse_input, main_loop
+    from opt import parse_input, main_loop, endpoint
     OPTIONS, ARGS = parse_input()
+    HOST, PORT = endpoint(OPTIONS)
     NODE = ConnectionFactory(
         instate=EchoIncomingAutomaton, outstate=EchoOutcomingAutomaton
     )
     if OPTIONS.server:
-        NODE.listen(OPTIONS.host, OPTIONS.port)
+        NODE.listen(HOST, PORT)
     else:
-        NODE.send(OPTIONS.host, OPTIONS.port, *ARGS)
+        NODE.send(HOST, PORT, *ARGS)
     main_loop()
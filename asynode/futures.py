@@ -0,0 +1,192 @@
+""" This module lets break point handlers wait for blocking work.
+
+A break point handler can return a :class:`Future` resolving to a
+:class:`state.State` instead of the :class:`state.State` itself: the
+:class:`core.Connection` stops reading from its socket until the future is
+done, then applies the resulting state, while other connections keep being
+served. Any object with ``add_done_callback`` and ``result``, like a
+:mod:`concurrent.futures` future, works as well. A future may also have a
+``lookahead`` method: it is called with the input already read behind the
+data of the break point, e.g. pipelined commands, before being waited on.
+
+Blocking work is usually handed to a :class:`ThreadPool` or, for CPU bound
+work on picklable functions, to a :class:`ProcessPool`.
+
+>>> pool = ThreadPool(2)
+>>> f = pool.submit(sum, [1, 2, 3])
+>>> f.result(timeout=1)
+6
+>>> pool.submit(int, 'x').exception(timeout=1)
+ValueError("invalid literal for int() with base 10: 'x'",)
+>>> pool.shutdown()
+"""
+import sys
+import threading
+import multiprocessing
+from Queue import Queue
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+__all__ = (
+    'Future',
+    'ThreadPool',
+    'ProcessPool',
+)
+
+class TimeoutError(Exception):
+    pass
+
+
+class Future(object):
+    """ The result of a computation that completes later, possibly in
+    another thread.
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def _wait(self, timeout):
+        with self._condition:
+            if not self._done:
+                self._condition.wait(timeout)
+            if not self._done:
+                raise TimeoutError()
+
+    def result(self, timeout=None):
+        """ Return the result, raising the exception of the computation if
+        it failed.
+        """
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        return self._exception
+
+    def add_done_callback(self, callback):
+        """ Call ``callback(future)`` once done, in the completing thread. """
+        with self._condition:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _complete(self, result, exception):
+        with self._condition:
+            self._result, self._exception = result, exception
+            self._done = True
+            self._condition.notify_all()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def set_result(self, result):
+        self._complete(result, None)
+
+    def set_exception(self, exception):
+        self._complete(None, exception)
+
+
+class ThreadPool(object):
+    """ Run blocking calls in a pool of threads.
+
+    :param workers: number of threads.
+    :type workers: :class:`int`
+    """
+    def __init__(self, workers=4):
+        " Initialize a new :class:`ThreadPool` and start its threads"
+        self._queue = Queue()
+        self._threads = []
+        for _ in range(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, func, args, kwargs = item
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                future.set_exception(sys.exc_info()[1])
+            else:
+                future.set_result(result)
+
+    def submit(self, func, *args, **kwargs):
+        """ Schedule ``func(*args, **kwargs)``.
+
+        :rtype: :class:`Future`
+        """
+        future = Future()
+        self._queue.put((future, func, args, kwargs))
+        return future
+
+    def shutdown(self):
+        """ Stop the threads once the pending calls are done. """
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+def _call(func, args, kwargs):
+    try:
+        result = func(*args, **kwargs)
+        pickle.dumps(result, 2)
+        return True, result
+    except Exception:
+        return False, sys.exc_info()[1]
+
+class ProcessPool(object):
+    """ Run calls in a pool of processes. Functions, arguments and results
+    must be picklable.
+
+    :param processes: number of processes (default the number of CPUs).
+    :type processes: :class:`int`
+
+    Calls that cannot be submitted fail their future:
+
+    >>> pool = ProcessPool(1)
+    >>> pool.submit(len, lambda: None).exception(timeout=1) is not None
+    True
+    >>> pool.shutdown()
+    """
+    def __init__(self, processes=None):
+        " Initialize a new :class:`ProcessPool`"
+        self._pool = multiprocessing.Pool(processes)
+
+    def submit(self, func, *args, **kwargs):
+        """ Schedule ``func(*args, **kwargs)``.
+
+        :rtype: :class:`Future`
+        """
+        future = Future()
+        def done(outcome):
+            if outcome[0]:
+                future.set_result(outcome[1])
+            else:
+                future.set_exception(outcome[1])
+        try:
+            pickle.dumps((func, args, kwargs), 2)
+            self._pool.apply_async(_call, (func, args, kwargs), callback=done)
+        except Exception:
+            future.set_exception(sys.exc_info()[1])
+        return future
+
+    def shutdown(self):
+        self._pool.close()
+        self._pool.join()
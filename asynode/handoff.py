@@ -0,0 +1,254 @@
+""" This module implements zero-downtime restarts.
+
+A process started with a :class:`Handoff` first asks the process already
+serving on the same Unix socket path for its listening sockets. The old
+process passes their file descriptors, stops accepting and drains its
+in-flight connections up to a deadline, then its loop stops. Since the
+listening sockets are never closed, no incoming connection is refused
+during the handover: the kernel queues them until the new process accepts
+them.
+
+The handover socket is only accessible to its owner, and both ends check
+that the peer runs as the same user. Inherited sockets the new process does
+not :meth:`~Handoff.take` during startup are closed at the first loop
+iteration.
+
+>>> from core import ConnectionFactory
+>>> from echo import EchoIncomingAutomaton
+>>> import tempfile, shutil
+>>> path = tempfile.mkdtemp()
+>>> old = ConnectionFactory(EchoIncomingAutomaton, None,
+...     handoff=Handoff(os.path.join(path, 'handoff')))
+>>> oct(os.stat(os.path.join(path, 'handoff')).st_mode & 0777)
+'0600'
+>>> listener = old.listen('localhost', 0)
+>>> port = listener.socket.getsockname()[1]
+>>> unused = old.listen('localhost', 0).socket.getsockname()[1]
+>>> import threading
+>>> def serve():
+...     while old.handoff.listeners:
+...         asyncore.loop(0.01, count=1)
+>>> t = threading.Thread(target=serve); t.start()
+>>> new = ConnectionFactory(EchoIncomingAutomaton, None,
+...     handoff=Handoff(os.path.join(path, 'handoff')))
+>>> t.join()
+>>> listener.accepting
+False
+>>> new.listen('localhost', port).socket.getsockname()[1] == port
+True
+>>> len(new.handoff.inherited)
+1
+>>> new.handoff.close_unclaimed()
+>>> socket.create_connection(('localhost', unused))
+Traceback (most recent call last):
+    ...
+error: [Errno 111] Connection refused
+>>> asyncore.close_all()
+
+Anything but a socket at the handover path is left alone:
+
+>>> open(os.path.join(path, 'file'), 'w').close()
+>>> Handoff(os.path.join(path, 'file')) # doctest: +ELLIPSIS
+Traceback (most recent call last):
+    ...
+HandoffError: ... exists and is not a socket
+>>> os.path.isfile(os.path.join(path, 'file'))
+True
+>>> shutil.rmtree(path)
+"""
+import os
+import stat
+import errno
+import socket
+import struct
+import asyncore
+import logging
+from multiprocessing.reduction import send_handle, recv_handle
+
+from core import Connection, sockaddr
+from loop import call_later, stop
+
+LOGGER = logging.getLogger('asynode.handoff')
+
+__all__ = (
+    'Handoff',
+    'HandoffError',
+)
+
+class HandoffError(Exception):
+    pass
+
+
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+UCRED = struct.Struct('3i')
+
+def same_user(conn):
+    """ Return ``True`` if the peer of the Unix socket ``conn`` runs as the
+    user of this process.
+    """
+    try:
+        _, uid, _ = UCRED.unpack(
+            conn.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, UCRED.size)
+        )
+    except (socket.error, struct.error):
+        return False
+    return uid == os.getuid()
+
+class HandoffServerd(asyncore.dispatcher):
+    """ Wait on a Unix socket for the process that takes over. """
+    def __init__(self, path, handoff):
+        asyncore.dispatcher.__init__(self)
+        self.path = path
+        self.handoff = handoff
+        try:
+            mode = os.lstat(path).st_mode
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        else:
+            if not stat.S_ISSOCK(mode):
+                raise HandoffError('{0} exists and is not a socket'.format(path))
+            os.unlink(path)
+        self.create_socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)
+        try:
+            self.bind(path)
+        finally:
+            os.umask(umask)
+        self.listen(1)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        conn = pair[0]
+        if not same_user(conn):
+            LOGGER.warning('Refusing handover to another user')
+            conn.close()
+            return
+        conn.setblocking(1)
+        try:
+            self.handoff.release(conn)
+        finally:
+            conn.close()
+        self.close()
+
+
+class Handoff(object):
+    """ Inherit listening sockets from the previous process, if any, and
+    hand them over to the next one.
+
+    :param path: Unix socket path used for the handover.
+    :type path: :class:`str`
+    :param deadline: seconds granted to in-flight connections after the
+        handover before being closed.
+    :type deadline: :class:`float`
+    """
+    def __init__(self, path, deadline=30.0):
+        " Initialize a new :class:`Handoff`"
+        self.path = path
+        self.deadline = deadline
+        self.listeners = []
+        self.inherited = self.receive()
+        self.server = HandoffServerd(path, self)
+        call_later(0, self.close_unclaimed)
+
+    def receive(self):
+        """ Receive the listening sockets of the previous process. """
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(self.path)
+        except socket.error:
+            return []
+        try:
+            if not same_user(conn):
+                LOGGER.warning('Refusing sockets from another user')
+                return []
+            header = ''
+            while not header.endswith('\n'):
+                data = conn.recv(1)
+                if not data:
+                    return []
+                header += data
+            inherited = []
+            for family in header.split():
+                fd = recv_handle(conn)
+                inherited.append(
+                    socket.fromfd(fd, int(family), socket.SOCK_STREAM)
+                )
+                os.close(fd)
+        finally:
+            conn.close()
+        LOGGER.info('Inherited {0} listening sockets'.format(len(inherited)))
+        return inherited
+
+    def take(self, host, port):
+        """ Return the inherited socket listening on ``port``, or on the
+        Unix socket ``host`` when ``port`` is ``None``, if any.
+        """
+        family, address = sockaddr(host, port)
+        for sock in self.inherited:
+            if family == socket.AF_UNIX:
+                found = sock.family == family and sock.getsockname() == address
+            else:
+                found = (
+                    sock.family != socket.AF_UNIX
+                    and sock.getsockname()[1] == port
+                )
+            if found:
+                self.inherited.remove(sock)
+                return sock
+        return None
+
+    def close_unclaimed(self):
+        """ Close the inherited sockets not taken during startup. """
+        for sock in self.inherited:
+            LOGGER.info('Closing unclaimed {0}'.format(sock.getsockname()))
+            sock.close()
+        self.inherited = []
+
+    def register(self, listener):
+        """ Track ``listener`` to hand it over on the next reload. """
+        self.listeners.append(listener)
+
+    def release(self, conn):
+        """ Pass the listening sockets through ``conn``, stop accepting and
+        start draining.
+        """
+        families = ' '.join(str(int(l.socket.family)) for l in self.listeners)
+        conn.sendall(families + '\n')
+        for listener in self.listeners:
+            send_handle(conn, listener.socket.fileno(), None)
+        for listener in self.listeners:
+            listener.close()
+        LOGGER.info('Handed over {0} listening sockets, draining'.format(
+            len(self.listeners)
+        ))
+        self.listeners = []
+        self.expires = call_later(self.deadline, self.expire)
+        self.drain()
+
+    @staticmethod
+    def connections():
+        return [
+            d for d in asyncore.socket_map.values()
+            if isinstance(d, Connection)
+        ]
+
+    def drain(self):
+        """ Stop the loop once every connection is closed. """
+        if self.connections():
+            call_later(0.1, self.drain)
+        else:
+            LOGGER.info('Drained')
+            self.expires.cancel()
+            stop()
+
+    def expire(self):
+        """ Close the connections still open at the deadline. """
+        connections = self.connections()
+        LOGGER.warning('Closing {0} connections at deadline'.format(
+            len(connections)
+        ))
+        for conn in connections:
+            conn.close()
@@ -1,9 +1,77 @@
-from asynode.opt import main_loop, parse_input
+import zlib
+
+from asynode.opt import main_loop, parse_input, endpoint
 from asynode.state import Automaton, State
 from asynode import __version__ as version
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 CRLF = "\r\n"
 HTTP = "HTTP/1.1"
+ENCODINGS = ('gzip', 'deflate', 'br') if brotli else ('gzip', 'deflate')
+
+class Deflate(object):
+    """ Decompress ``deflate`` bodies, either zlib wrapped or raw, as both
+    are found in the wild.
+    """
+    def __init__(self):
+        self._decompressor = None
+
+    def decompress(self, data, max_length=0):
+        if self._decompressor is None:
+            raw = len(data) < 2 or (ord(data[0]) << 8 | ord(data[1])) % 31
+            self._decompressor = zlib.decompressobj(
+                -zlib.MAX_WBITS if raw else zlib.MAX_WBITS
+            )
+        return self._decompressor.decompress(data, max_length)
+
+    @property
+    def unconsumed_tail(self):
+        return self._decompressor.unconsumed_tail if self._decompressor else ''
+
+    def flush(self):
+        return self._decompressor.flush() if self._decompressor else ''
+
+
+class Brotli(object):
+    """ Decompress ``br`` bodies. The decompressor cannot bound its output,
+    so input is fed in small slices instead.
+    """
+    slice_size = 1024
+
+    def __init__(self):
+        self._decompressor = brotli.Decompressor()
+        self._decompress = getattr(
+            self._decompressor, 'process', None
+        ) or self._decompressor.decompress
+        self.unconsumed_tail = ''
+
+    def decompress(self, data, max_length=0):
+        self.unconsumed_tail = data[self.slice_size:]
+        return self._decompress(data[:self.slice_size])
+
+    def flush(self):
+        return ''
+
+
+def decoder(encoding):
+    """ Return an incremental decoder for a ``Content-Encoding``, ``None``
+    for ``identity``.
+    """
+    encoding = encoding.strip().lower()
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        return Deflate()
+    if encoding == 'br' and brotli is not None:
+        return Brotli()
+    if encoding in ('', 'identity'):
+        return None
+    raise ValueError('Unsupported Content-Encoding {0!r}'.format(encoding))
+
 
 class HTTPOutcomingAutomaton(Automaton):
     def __init__(self, *args, **kwargs):
@@ -11,66 +79,237 @@ class HTTPOutcomingAutomaton(Automaton):
         >>> s = HTTPOutcomingAutomaton(
         ...     method = 'get',
         ...     path = '/',
-        ...     hostname = 'localhost'
+        ...     hostname = 'localhost',
+        ...     ua = 'Asynode',
+        ...     encodings = ('gzip', 'deflate'),
         ... )
         >>> s._method
         'GET'
         >>> s._headers == {
         ... 'Host': 'localhost',
-        ... 'Accept-Encoding': 'identity',
-        ... 'User-Agent': 'Asynode ' + version
+        ... 'Accept-Encoding': 'gzip, deflate',
+        ... 'User-Agent': 'Asynode'
         ... }
         True
         >>> s._body
         >>> s.next(None, 'INITIAL') #INIT
-        State(push=None, terminator='\r\n\r\n', close=False, final=False)
+        State(push=None, terminator='\r\n\r\n', close=False, final=False, maxline=None, maxbuffer=None)
         >>> s.next(None)
-        State(push='GET / HTTP/1.1\r\nHost: localhost\r\nAccept-Encoding: identity\r\nUser-Agent: Asynode 0.1\r\n\r\n', terminator=None, close=False, final=False)
-        >>> s.next('HTTP/1.0 200 OK')
-        State(push=None, terminator=None, close=True, final=True)
+        State(push='GET / HTTP/1.1\r\nHost: localhost\r\nAccept-Encoding: gzip, deflate\r\nUser-Agent: Asynode\r\n\r\n', terminator=None, close=False, final=False, maxline=None, maxbuffer=None)
+        >>> s.next('HTTP/1.0 204 No Content')
+        State(push=None, terminator=None, close=True, final=True, maxline=None, maxbuffer=None)
+
+        Bodies are decoded while they arrive and handed to ``consumer``:
+
+        >>> gzip = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        >>> body = gzip.compress('Hello World!' * 10) + gzip.flush()
+        >>> chunks = []
+        >>> s = HTTPOutcomingAutomaton(path='/', hostname='localhost',
+        ...     consumer=chunks.append, chunk_size=16)
+        >>> _ = s.next(None, 'INITIAL'), s.next(None)
+        >>> s.next('HTTP/1.1 200 OK\r\nContent-Encoding: gzip\r\n'
+        ...     'Transfer-Encoding: chunked')
+        State(push=None, terminator='\r\n', close=False, final=False, maxline=None, maxbuffer=None)
+        >>> s.status, s.headers['content-encoding']
+        (200, 'gzip')
+        >>> state = s.next('%x' % len(body))
+        >>> state
+        State(push=None, terminator=16, close=False, final=False, maxline=None, maxbuffer=None)
+        >>> wire = body + '\r\n'
+        >>> while isinstance(state.terminator, int):
+        ...     data, wire = wire[:state.terminator], wire[state.terminator:]
+        ...     state = s.next(data)
+        >>> state, wire
+        (State(push=None, terminator='\r\n', close=False, final=False, maxline=None, maxbuffer=None), '')
+        >>> s.next('0')
+        State(push=None, terminator='\r\n', close=False, final=False, maxline=None, maxbuffer=None)
+        >>> s.next('')
+        State(push=None, terminator=None, close=True, final=True, maxline=None, maxbuffer=None)
+        >>> ''.join(chunks) == 'Hello World!' * 10
+        True
+
+        Decoded data is handed over in blocks of at most ``chunk_size``
+        bytes, however well it compresses:
+
+        >>> deflate = zlib.compressobj(9)
+        >>> body = deflate.compress('\0' * 1024 * 1024) + deflate.flush()
+        >>> chunks = []
+        >>> s = HTTPOutcomingAutomaton(path='/', hostname='localhost',
+        ...     consumer=chunks.append, chunk_size=4096)
+        >>> _ = s.next(None, 'INITIAL'), s.next(None)
+        >>> s.next('HTTP/1.1 200 OK\r\nContent-Encoding: deflate\r\n'
+        ...     'Content-Length: %d' % len(body)).terminator == len(body)
+        True
+        >>> s.next(body)
+        State(push=None, terminator=None, close=True, final=True, maxline=None, maxbuffer=None)
+        >>> len(chunks), max(len(c) for c in chunks)
+        (256, 4096)
+
+        Informational responses are skipped, and a failed exchange closes
+        the connection:
+
+        >>> s = HTTPOutcomingAutomaton(path='/', hostname='localhost')
+        >>> _ = s.next(None, 'INITIAL'), s.next(None)
+        >>> s.next('HTTP/1.1 100 Continue')
+        State(push=None, terminator='\r\n\r\n', close=False, final=False, maxline=None, maxbuffer=None)
+        >>> s.next('HTTP/1.1 204 No Content').final, s.status
+        (True, 204)
+        >>> s.next(None, 'ERROR')
+        State(push=None, terminator=None, close=True, final=True, maxline=None, maxbuffer=None)
         """
         self._method = kwargs.get('method', 'GET').upper()
         self._path = kwargs['path']
         self._headers = {
             'Host': kwargs['hostname'],
-            'Accept-Encoding': 'identity',
+            'Accept-Encoding': ', '.join(kwargs.get('encodings', ENCODINGS)),
             'User-Agent': kwargs.get('ua', 'Asynode '+ version)
         }
         self._headers.update(kwargs.get('headers', {}))
         self._body = kwargs.get('body')
+        self.consumer = kwargs.get('consumer', lambda chunk: None)
+        self.chunk_size = kwargs.get('chunk_size', 16 * 1024)
+        self.status = None
+        self.headers = {}
+        self._read = self._request
+        self._decoder = None
+        self._remaining = 0
+        self._skip = 0
 
     def initial(self, data):
         return State.get_push(terminator=CRLF*2)
 
     def operative(self, data):
-        if data:
-            return State.get_final(close=True)
+        return self._read(data)
+
+    def error(self, data):
+        self._decoder = None
+        self._read = self._done
+        return State.get_final(close=True)
+
+    def closed(self, data):
+        if self._read == self._until_close:
+            self._feed(data)
+            return self._finish()
+        return State.get_push()
+
+    def _request(self, data):
         push = ' '.join([self._method, self._path, HTTP])
         for k,v in self._headers.iteritems():
             push += CRLF + k + ': ' + v
         push += CRLF*2
+        self._read = self._head
         return State.get_push(push=push)
 
+    def _head(self, data):
+        lines = data.split(CRLF)
+        self.status = int(lines[0].split()[1])
+        if 100 <= self.status < 200 and self.status != 101:
+            return State.get_push(terminator=CRLF*2)
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            self.headers[name.strip().lower()] = value.strip()
+        self._decoder = decoder(self.headers.get('content-encoding', ''))
+        if self._method == 'HEAD' or self.status in (101, 204, 304):
+            return self._finish()
+        if 'chunked' in self.headers.get('transfer-encoding', '').lower():
+            self._read = self._chunk_size
+            return State.get_push(terminator=CRLF)
+        if 'content-length' in self.headers:
+            self._remaining = int(self.headers['content-length'])
+            self._read = self._content
+            return self._next_block()
+        self._read = self._until_close
+        return State.get_push(terminator=self.chunk_size)
+
+    def _next_block(self):
+        if not self._remaining:
+            return self._finish()
+        return State.get_push(terminator=min(self._remaining, self.chunk_size))
+
+    def _content(self, data):
+        self._remaining -= len(data)
+        self._feed(data)
+        return self._next_block()
+
+    def _until_close(self, data):
+        self._feed(data)
+        return State.get_push(terminator=self.chunk_size)
+
+    def _chunk_size(self, data):
+        size = int(data.split(';', 1)[0].strip(), 16)
+        if not size:
+            self._read = self._trailer
+            return State.get_push(terminator=CRLF)
+        self._remaining, self._skip = size, len(CRLF)
+        self._read = self._chunk
+        return self._next_chunk_block()
+
+    def _next_chunk_block(self):
+        return State.get_push(
+            terminator=min(self._remaining + self._skip, self.chunk_size)
+        )
+
+    def _chunk(self, data):
+        body = data[:self._remaining]
+        self._remaining -= len(body)
+        self._skip -= len(data) - len(body)
+        self._feed(body)
+        if self._remaining or self._skip:
+            return self._next_chunk_block()
+        self._read = self._chunk_size
+        return State.get_push(terminator=CRLF)
+
+    def _trailer(self, data):
+        if data:
+            return State.get_push()
+        return self._finish()
+
+    def _feed(self, data):
+        if self._decoder is None:
+            if data:
+                self.consumer(data)
+            return
+        while data:
+            block = self._decoder.decompress(data, self.chunk_size)
+            data = self._decoder.unconsumed_tail
+            if block:
+                self.consumer(block)
+
+    def _finish(self):
+        if self._decoder is not None:
+            tail = self._decoder.flush()
+            if tail:
+                self.consumer(tail)
+            self._decoder = None
+        self._read = self._done
+        return State.get_final(close=True)
+
+    def _done(self, data):
+        return State.get_final(close=True)
+
 
 if __name__ == '__main__':
     import logging
     logging.basicConfig(level=logging.INFO)
     options, args = parse_input()
+    host, port = endpoint(options)
     from core import ConnectionFactory
     node = ConnectionFactory(
         instate=None, outstate=HTTPOutcomingAutomaton
     )
     if options.server:
-        node.listen(options.host, options.port)
+        node.listen(host, port)
     else:
+        import sys
         kwargs = {
             'path':'/api/1.0/',
             'hostname': options.host,
             'headers': {
                 'Accept': 'application/xml'
-            }
+            },
+            'consumer': sys.stdout.write,
         }
         node.send(
-            options.host, options.port, *args, **kwargs
+            host, port, *args, **kwargs
         )
     main_loop()
@@ -5,18 +5,45 @@ class LMTPOutcomingAutomaton(SMTPOutcomingAutomaton):
     def _helo(localname):
         return 'LHLO '+ localname, '250'
 
+    _ehlo = _helo
+
+    def _negotiate(self, lines):
+        """ Send with ``DATA`` even to servers announcing ``CHUNKING``:
+        per-recipient replies to ``BDAT`` are not read yet.
+        """
+        super(LMTPOutcomingAutomaton, self)._negotiate(lines)
+        if 'CHUNKING' in self.extensions:
+            del self.extensions['CHUNKING']
+            self._indata = list(self._transaction())
+
 class LMTPIncomingAutomaton(SMTPIncomingAutomaton):
+    r'''
+    ``CHUNKING`` is not announced, as per-recipient replies to ``BDAT`` are
+    not implemented:
+
+    >>> s = LMTPIncomingAutomaton(fqdn='z4r.buongiorno.loc')
+    >>> s.next('LHLO @work').push.split('\r\n')
+    ['250-z4r.buongiorno.loc', '250-8BITMIME', '250 SIZE 10485760', '']
+    >>> s.next('BDAT 14 LAST').push
+    "502 Error: command 'BDAT' not implemented\r\n"
+    '''
     def _lhlo(self, arg):
         if not arg:
             return self.reply('501 Syntax: LHLO hostname')
         if self._greeting:
             return self.reply('503 Duplicate LHLO')
         self._greeting = arg
-        return self.reply('250 {s.fqdn}'.format(s=self))
+        return self.reply(self.context.announce(['8BITMIME']))
+
+    def _bdat(self, arg):
+        return self.not_implemented('BDAT')
 
     def _helo(self, arg):
         return self.not_implemented('HELO')
 
+    def _ehlo(self, arg):
+        return self.not_implemented('EHLO')
+
 if __name__ == '__main__':
     from opt import main_mail
     main_mail(instate=LMTPIncomingAutomaton, outstate=LMTPOutcomingAutomaton)
\ No newline at end of file
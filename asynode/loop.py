@@ -0,0 +1,190 @@
+""" This module drives the asyncore loop together with a timer queue, so
+that nodes can schedule timeouts and delayed actions without blocking.
+
+>>> fired = []
+>>> t = call_later(0, fired.append, 'first')
+>>> call_later(0, fired.append, 'second').cancel()
+>>> run()
+>>> fired
+['first']
+
+A ``daemon`` timer does not keep :func:`run` going on its own:
+
+>>> t = call_later(60, fired.append, 'never', daemon=True)
+>>> run()
+>>> t.cancel()
+"""
+import os
+import fcntl
+import asyncore
+import heapq
+import time
+import logging
+import itertools
+import threading
+from collections import deque
+
+LOGGER = logging.getLogger('asynode.loop')
+
+__all__ = (
+    'Timer',
+    'call_later',
+    'call_soon_threadsafe',
+    'run',
+    'stop',
+)
+
+_timers = []
+_stopped = []
+_ready = deque()
+_lock = threading.Lock()
+_waker = []
+_sequence = itertools.count()
+_daemons = [0]
+
+class Timer(object):
+    """ A callback scheduled on the loop. Returned by :func:`call_later`. """
+    def __init__(self, when, func, args, daemon=False):
+        self.when = when
+        self.func = func
+        self.args = args
+        self.daemon = daemon
+        self.cancelled = False
+
+    def cancel(self):
+        """ Prevent the callback from running. """
+        self.cancelled = True
+
+
+def call_later(delay, func, *args, **kwargs):
+    """ Schedule ``func(*args)`` to run after ``delay`` seconds. With
+    ``daemon=True``, the timer alone does not keep :func:`run` going.
+
+    :rtype: :class:`Timer`
+    """
+    timer = Timer(time.time() + delay, func, args, kwargs.get('daemon', False))
+    heapq.heappush(_timers, (timer.when, next(_sequence), timer))
+    _daemons[0] += timer.daemon
+    return timer
+
+def _pop():
+    _, _, timer = heapq.heappop(_timers)
+    _daemons[0] -= timer.daemon
+    return timer
+
+class Waker(asyncore.file_dispatcher):
+    """ Wake up the loop from other threads through a pipe. """
+    def __init__(self):
+        rfd, self.wfd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, rfd)
+        os.close(rfd)
+        fcntl.fcntl(self.wfd, fcntl.F_SETFL,
+            fcntl.fcntl(self.wfd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def wake(self):
+        try:
+            os.write(self.wfd, 'x')
+        except OSError:
+            pass
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except (OSError, IOError):
+            pass
+        run_ready()
+
+    def handle_error(self):
+        LOGGER.exception('Waker error')
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        try:
+            os.close(self.wfd)
+        except OSError:
+            pass
+
+
+def waker():
+    """ Return the :class:`Waker` of the loop, creating it if needed. Create
+    it from the loop thread before handing work to other threads, so that
+    the loop is already watching it.
+    """
+    with _lock:
+        if _waker and _waker[0]._fileno not in asyncore.socket_map:
+            LOGGER.warning('Replacing a closed waker')
+            del _waker[:]
+        if not _waker:
+            _waker.append(Waker())
+        return _waker[0]
+
+def call_soon_threadsafe(func, *args):
+    """ Schedule ``func(*args)`` on the loop from any thread. """
+    _ready.append((func, args))
+    waker().wake()
+
+def run_ready():
+    """ Run the callbacks scheduled with :func:`call_soon_threadsafe`. """
+    while _ready:
+        func, args = _ready.popleft()
+        try:
+            func(*args)
+        except Exception:
+            LOGGER.exception('Callback {0!r} failed'.format(func))
+
+def channels(map):
+    """ Number of channels in ``map``, the waker excluded. """
+    return len(map) - (bool(_waker) and _waker[0]._fileno in map)
+
+def run_timers():
+    """ Run every timer that is due. """
+    now = time.time()
+    while _timers and _timers[0][0] <= now:
+        timer = _pop()
+        if not timer.cancelled:
+            try:
+                timer.func(*timer.args)
+            except Exception:
+                LOGGER.exception('Timer {0!r} failed'.format(timer.func))
+
+def _purge():
+    while _timers and _timers[0][2].cancelled:
+        _pop()
+
+def pending():
+    """ Return ``True`` if some timer, daemons excluded, is still
+    scheduled.
+    """
+    _purge()
+    return len(_timers) > _daemons[0]
+
+def next_timeout(default):
+    """ Seconds until the next timer is due, at most ``default``. """
+    _purge()
+    if not _timers:
+        return default
+    return max(0, min(default, _timers[0][0] - time.time()))
+
+def stop():
+    """ Make :func:`run` return after the current iteration. """
+    _stopped.append(True)
+
+def run(timeout=30.0, use_poll=False, map=None):
+    """ Like :func:`asyncore.loop`, but it also runs scheduled timers.
+    It returns when there are no more channels nor timers, or when
+    :func:`stop` is called.
+    """
+    if map is None:
+        map = asyncore.socket_map
+    del _stopped[:]
+    while (channels(map) or pending() or _ready) and not _stopped:
+        wait = next_timeout(timeout)
+        if map:
+            asyncore.loop(wait, use_poll, map, count=1)
+        else:
+            time.sleep(wait)
+        run_ready()
+        run_timers()
@@ -0,0 +1,138 @@
+""" This module instruments the loop to find what blocks it.
+
+A :class:`Monitor` measures the lag of the loop with a periodic timer and,
+once installed, times every :meth:`core.Connection.process` call: calls
+slower than a threshold are logged with their break point, automaton and
+peer. A signal toggles a profiler around those calls, to find the hot
+states on demand. When not installed, nothing is measured and nothing is
+paid.
+
+>>> from core import Connection
+>>> m = Monitor(threshold=1).install()
+>>> Connection.__dict__['process'] is Monitor.original
+False
+>>> m.uninstall()
+>>> Connection.__dict__['process'] is Monitor.original
+True
+
+Probing does not keep the loop running:
+
+>>> from loop import run
+>>> m = Monitor(threshold=1, interval=0.01).install()
+>>> run()
+>>> m.uninstall()
+"""
+import time
+import signal
+import logging
+import cProfile
+import pstats
+from StringIO import StringIO
+
+from core import Connection
+from loop import call_later
+
+LOGGER = logging.getLogger('asynode.monitor')
+
+__all__ = (
+    'Monitor',
+)
+
+class Monitor(object):
+    """ Loop lag monitor and break point profiler.
+
+    :param threshold: seconds above which a call or a loop lag is reported.
+    :type threshold: :class:`float`
+    :param interval: seconds between two loop lag probes.
+    :type interval: :class:`float`
+    :param signum: signal toggling the profiler, ``None`` to disable it.
+    :type signum: :class:`int`
+    """
+    original = staticmethod(Connection.__dict__['process'])
+
+    def __init__(self, threshold=0.1, interval=1.0, signum=signal.SIGUSR1):
+        " Initialize a new :class:`Monitor`"
+        self.threshold = threshold
+        self.interval = interval
+        self.signum = signum
+        self.lag = 0.0
+        self.maxlag = 0.0
+        self.stats = {}
+        self.profiler = None
+        self._timer = None
+
+    def install(self):
+        """ Start probing the loop and timing break points. """
+        monitor = self
+        original = self.original
+        def process(conn, state, data):
+            start = time.time()
+            try:
+                if monitor.profiler is None:
+                    return original(conn, state, data)
+                return monitor.profiler.runcall(original, conn, state, data)
+            finally:
+                monitor.observe(conn, state, time.time() - start)
+        Connection.process = process
+        if self.signum is not None:
+            signal.signal(self.signum, lambda signum, frame: self.toggle())
+        self._probe(time.time())
+        return self
+
+    def uninstall(self):
+        """ Restore the uninstrumented :class:`core.Connection`. """
+        Connection.process = self.original
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self.signum is not None:
+            signal.signal(self.signum, signal.SIG_DFL)
+
+    def _probe(self, expected):
+        now = time.time()
+        self.lag = max(0.0, now - expected)
+        self.maxlag = max(self.maxlag, self.lag)
+        if self.lag > self.threshold:
+            LOGGER.warning('Loop lagged {0:.3f}s'.format(self.lag))
+        self._timer = call_later(
+            self.interval, self._probe, now + self.interval, daemon=True
+        )
+
+    def observe(self, conn, state, elapsed):
+        """ Account ``elapsed`` seconds spent processing ``state``. """
+        key = type(conn.automaton).__name__, state
+        calls, total, worst = self.stats.get(key, (0, 0.0, 0.0))
+        self.stats[key] = calls + 1, total + elapsed, max(worst, elapsed)
+        if elapsed > self.threshold:
+            LOGGER.warning('Slow {0} of {1} for {2}: {3:.3f}s'.format(
+                state, key[0], conn.remote, elapsed
+            ))
+
+    def toggle(self):
+        """ Start the profiler, or stop it and log its report. """
+        if self.profiler is None:
+            LOGGER.info('Profiling break points')
+            self.profiler = cProfile.Profile()
+        else:
+            profiler, self.profiler = self.profiler, None
+            LOGGER.info(self.report(profiler))
+
+    def report(self, profiler=None, limit=20):
+        """ Return per break point statistics, followed by the hottest
+        functions of ``profiler``.
+        """
+        lines = ['{0:<40} {1:>8} {2:>10} {3:>10}'.format(
+            'automaton/state', 'calls', 'total', 'worst'
+        )]
+        ranking = sorted(self.stats.items(), key=lambda i: -i[1][1])
+        for (automaton, state), (calls, total, worst) in ranking:
+            lines.append('{0:<40} {1:>8} {2:>10.4f} {3:>10.4f}'.format(
+                automaton + '/' + state, calls, total, worst
+            ))
+        if profiler is not None:
+            out = StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats(
+                'cumulative'
+            ).print_stats(limit)
+            lines.append(out.getvalue())
+        return '\n'.join(lines)
@@ -21,12 +21,45 @@ def parse_input():
         help    = 'Port [8000]',
         default = 8000,
     )
+    parser.add_option('-u', '--unix',
+        action  = 'store',
+        dest    = 'unix',
+        help    = 'Unix socket path instead of host:port, @name for the abstract namespace',
+        default = None,
+    )
+    parser.add_option('-r', '--reload',
+        action  = 'store',
+        dest    = 'reload',
+        help    = 'Take over listening sockets through this Unix socket',
+        default = None,
+    )
+    parser.add_option('-w', '--record',
+        action  = 'store',
+        dest    = 'record',
+        help    = 'Record wire transcripts, message contents included, to this file',
+        default = None,
+    )
+    parser.add_option('-m', '--monitor',
+        action  = 'store',
+        dest    = 'monitor',
+        type    = 'float',
+        help    = 'Report loop lags and calls slower than these seconds',
+        default = None,
+    )
     return parser.parse_args()
 
+def endpoint(options):
+    """ Return the ``(host, port)`` to listen on or to connect to, ``port``
+    being ``None`` for a Unix socket.
+    """
+    if options.unix:
+        return options.unix, None
+    return options.host, options.port
+
 def main_loop():
-    import asyncore
+    from loop import run
     try:
-        asyncore.loop()
+        run()
     except KeyboardInterrupt:
         import sys
         sys.exit()
@@ -52,15 +85,30 @@ def main_mail(instate, outstate):
     import logging
     logging.basicConfig(level=logging.INFO)
     options, args = parse_input()
-    from core import ConnectionFactory
+    from core import Connection, ConnectionFactory
+    from handoff import Handoff
+    if options.record:
+        from replay import Recorder
+        Connection.recorder = Recorder(options.record)
+    if options.monitor is not None:
+        from monitor import Monitor
+        Monitor(threshold=options.monitor).install()
+    from smtp import SMTPContext
     node = ConnectionFactory(
-        instate=instate, outstate=outstate
+        instate=instate, outstate=outstate,
+        handoff=Handoff(options.reload) if options.reload else None,
+        context=SMTPContext() if options.server else None,
     )
+    host, port = endpoint(options)
     if options.server:
-        node.listen(options.host, options.port)
+        node.listen(host, port)
     else:
         kwargs = interactive()
         node.send(
-            options.host, options.port, *args, **kwargs
+            host, port, *args, **kwargs
         )
-    main_loop()
+    try:
+        main_loop()
+    finally:
+        if Connection.recorder is not None:
+            Connection.recorder.close()
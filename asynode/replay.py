@@ -0,0 +1,358 @@
+""" This module records wire transcripts of connections and replays them,
+to reproduce production load patterns and to compare the cost of
+automatons between versions.
+
+A :class:`Recorder` set as :attr:`core.Connection.recorder` appends a record
+for every connection event to a binary file. Records are a ``!dIBI`` header,
+holding *timestamp*, *connection id*, *kind* and *length*, followed by
+*length* bytes of payload:
+
++-------------+-----------------------------------------+
+| Kind        | Payload                                 |
++=============+=========================================+
+| ``OPEN``    | ``module.Class`` of the automaton       |
++-------------+-----------------------------------------+
+| ``CONNECT`` | nothing, the connection is outcoming    |
++-------------+-----------------------------------------+
+| ``RECV``    | bytes read from the socket              |
++-------------+-----------------------------------------+
+| ``SEND``    | bytes pushed by the automaton           |
++-------------+-----------------------------------------+
+| ``CLOSE``   | nothing                                 |
++-------------+-----------------------------------------+
+
+Transcripts hold message contents. Credentials given inline to ``AUTH``,
+like ``AUTH PLAIN <token>``, are redacted, but those sent on continuation
+lines, as with ``AUTH LOGIN``, are captured.
+
+Transcripts are replayed through :func:`replay` in-process, without
+sockets, or through :func:`replay_live` against a listening node.
+
+>>> import tempfile
+>>> from echo import EchoIncomingAutomaton
+>>> path = tempfile.mktemp()
+>>> r = Recorder(path)
+>>> r.write(1, OPEN, 'echo.EchoIncomingAutomaton', 0.0)
+>>> r.write(1, RECV, 'hello\\nwor', 0.0)
+>>> r.write(1, SEND, 'hello\\n', 0.0)
+>>> r.write(1, RECV, 'ld\\n\\n', 0.1)
+>>> r.close()
+>>> players = replay(path, {'echo.EchoIncomingAutomaton': EchoIncomingAutomaton})
+>>> players[1].sent, players[1].closed
+(['hello\\n', 'world\\n'], True)
+>>> os.remove(path)
+"""
+import os
+import re
+import time
+import struct
+import socket
+import asyncore
+import logging
+
+from loop import call_later
+
+LOGGER = logging.getLogger('asynode.replay')
+
+__all__ = (
+    'Recorder',
+    'Player',
+    'read',
+    'replay',
+    'replay_live',
+)
+
+MAGIC = 'ASYREC01'
+RECORD = struct.Struct('!dIBI')
+OPEN, CONNECT, RECV, SEND, CLOSE = range(5)
+AUTH = re.compile(r'^(AUTH[ \t]+\S+[ \t]+)\S+', re.I | re.M)
+
+class Recorder(object):
+    r""" Append timestamped connection events to the file at ``path``.
+
+    :param path: transcript file.
+    :type path: :class:`str`
+    :param interval: seconds between two flushes of the file.
+    :type interval: :class:`float`
+
+    >>> Recorder.redact('EHLO @work\r\nAUTH PLAIN AHVzZXIAcGFzcw==\r\n')
+    'EHLO @work\r\nAUTH PLAIN *\r\n'
+    """
+    def __init__(self, path, interval=1.0):
+        " Initialize a new :class:`Recorder`"
+        self.file = open(path, 'ab')
+        if not self.file.tell():
+            self.file.write(MAGIC)
+        self.interval = interval
+        self._ids = {}
+        self._next = 0
+        self._timer = call_later(interval, self._flush, daemon=True)
+
+    @staticmethod
+    def redact(data):
+        """ Mask the credentials given inline to ``AUTH`` in ``data``. """
+        return AUTH.sub(r'\1*', data)
+
+    def write(self, cid, kind, data='', when=None):
+        """ Append a raw record. """
+        when = time.time() if when is None else when
+        self.file.write(RECORD.pack(when, cid, kind, len(data)))
+        self.file.write(data)
+
+    def record(self, conn, kind, data=''):
+        """ Append an event of connection ``conn``. """
+        key = id(conn)
+        if kind == OPEN:
+            self._next += 1
+            self._ids[key] = self._next
+            automaton = type(conn.automaton)
+            data = '{0}.{1}'.format(automaton.__module__, automaton.__name__)
+        cid = self._ids.get(key)
+        if cid is None:
+            return
+        if kind == CLOSE:
+            del self._ids[key]
+        elif kind in (RECV, SEND):
+            data = self.redact(data)
+        self.write(cid, kind, data)
+
+    def _flush(self):
+        self.flush()
+        self._timer = call_later(self.interval, self._flush, daemon=True)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        """ Stop flushing periodically, flush and close the file. """
+        self._timer.cancel()
+        self.file.close()
+
+
+def read(path):
+    """ Iterate over ``(timestamp, cid, kind, data)`` records of a
+    transcript.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{0} is not a transcript'.format(path))
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            when, cid, kind, length = RECORD.unpack(header)
+            yield when, cid, kind, f.read(length)
+
+
+class Player(object):
+    """ Drive an automaton with recorded data, as a :class:`core.Connection`
+    would, but without any socket. Pushed data is collected in :attr:`sent`.
+    Futures returned by break points are waited for.
+
+    >>> from futures import ThreadPool
+    >>> from smtp import SMTPContext, SMTPIncomingAutomaton, RecipientPolicy
+    >>> c = SMTPContext(fqdn='z4r.buongiorno.loc',
+    ...     policy=RecipientPolicy(lambda a: {}), executor=ThreadPool(1))
+    >>> p = Player(SMTPIncomingAutomaton(context=c))
+    >>> p.feed('MAIL FROM: <me@work.it>\\r\\nRCPT TO: <you@work.it>\\r\\n')
+    >>> p.sent[-1]
+    '550 No such user here\\r\\n'
+    """
+    def __init__(self, automaton):
+        self.automaton = automaton
+        self.sent = []
+        self.closed = False
+        self._buffer = []
+        self._inbuffer = ''
+        self._terminator = None
+        self.process('INITIAL')
+
+    def process(self, state):
+        next_state = self.automaton.next(''.join(self._buffer), state)
+        if hasattr(next_state, 'add_done_callback'):
+            lookahead = getattr(next_state, 'lookahead', None)
+            if lookahead is not None:
+                lookahead(self._inbuffer)
+            try:
+                next_state = next_state.result()
+            except Exception:
+                LOGGER.exception('Break point failed')
+                return self.process('ERROR')
+        if next_state.terminator is not None:
+            self._terminator = next_state.terminator
+        if next_state.push is not None:
+            self.sent.append(next_state.push)
+        if next_state.close:
+            self.closed = True
+
+    def connect(self):
+        self.process('OPERATIVE')
+
+    def feed(self, data):
+        """ Split ``data`` on terminators like :class:`asynchat.async_chat`. """
+        self._inbuffer += data
+        while self._inbuffer and not self.closed:
+            terminator = self._terminator
+            if not terminator:
+                self._buffer.append(self._inbuffer)
+                self._inbuffer = ''
+            elif isinstance(terminator, (int, long)):
+                chunk = self._inbuffer[:terminator]
+                self._buffer.append(chunk)
+                self._inbuffer = self._inbuffer[len(chunk):]
+                self._terminator = terminator - len(chunk)
+                if not self._terminator:
+                    self.found_terminator()
+            else:
+                index = self._inbuffer.find(terminator)
+                if index < 0:
+                    return
+                self._buffer.append(self._inbuffer[:index])
+                self._inbuffer = self._inbuffer[index+len(terminator):]
+                self.found_terminator()
+
+    def found_terminator(self):
+        if not ''.join(self._buffer):
+            self.process('CLOSED')
+            self.closed = True
+        self.process('OPERATIVE')
+        self._buffer = []
+
+
+def replay(path, automatons, speed=0):
+    """ Replay a transcript in-process.
+
+    :param automatons: maps the recorded ``module.Class`` of each
+        connection to the break point handler factory to replay it with.
+    :type automatons: :class:`dict`
+    :param speed: ``1`` replays with the recorded timing, ``0`` as fast as
+        possible.
+    :returns: the :class:`Player` of every connection, by connection id.
+    """
+    players, origin, start = {}, None, time.time()
+    for when, cid, kind, data in read(path):
+        if speed:
+            origin = when if origin is None else origin
+            delay = (when - origin) / speed - (time.time() - start)
+            if delay > 0:
+                time.sleep(delay)
+        if kind == OPEN:
+            if data in automatons:
+                players[cid] = Player(automatons[data]())
+        elif cid not in players:
+            continue
+        elif kind == CONNECT:
+            players[cid].connect()
+        elif kind == RECV:
+            players[cid].feed(data)
+    return players
+
+
+class LiveClient(asyncore.dispatcher):
+    """ Send the recorded input of an incoming connection to a listener at
+    ``endpoint``, a ``(host, port)`` pair as accepted by
+    :func:`core.sockaddr`.
+    """
+    def __init__(self, endpoint, chunks, speed):
+        from core import sockaddr
+        asyncore.dispatcher.__init__(self)
+        self.chunks = chunks
+        self.speed = speed
+        self.outbuffer = ''
+        self.received = 0
+        family, address = sockaddr(*endpoint)
+        self.create_socket(family, socket.SOCK_STREAM)
+        self.connect(address)
+
+    def handle_connect(self):
+        for offset, data in self.chunks:
+            if self.speed:
+                call_later(offset / self.speed, self.enqueue, data)
+            else:
+                self.enqueue(data)
+
+    def enqueue(self, data):
+        self.outbuffer += data
+
+    def writable(self):
+        return not self.connected or bool(self.outbuffer)
+
+    def handle_write(self):
+        sent = self.send(self.outbuffer)
+        self.outbuffer = self.outbuffer[sent:]
+
+    def handle_read(self):
+        self.received += len(self.recv(65536))
+
+    def handle_close(self):
+        self.close()
+
+
+def replay_live(path, endpoint, speed=0, automatons=None):
+    """ Replay the incoming connections of a transcript against the node
+    listening on ``endpoint``, a ``(host, port)`` pair, ``port`` being
+    ``None`` for a Unix socket, with the recorded inter-connection timing
+    when ``speed`` is not ``0``. Only connections recorded with automatons
+    in ``automatons`` are replayed, if given. Run the loop to proceed.
+    """
+    sessions, opened = {}, {}
+    for when, cid, kind, data in read(path):
+        if kind == OPEN:
+            if automatons is None or data in automatons:
+                sessions[cid], opened[cid] = [], when
+        elif kind == CONNECT:
+            sessions.pop(cid, None)
+        elif kind == RECV and cid in sessions:
+            sessions[cid].append((when - opened[cid], data))
+    if not opened:
+        return
+    origin = min(opened.values())
+    for cid, chunks in sessions.items():
+        if speed:
+            call_later(
+                (opened[cid] - origin) / speed,
+                LiveClient, endpoint, chunks, speed,
+            )
+        else:
+            LiveClient(endpoint, chunks, speed)
+
+
+if __name__ == '__main__':
+    import sys
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog [options] transcript module.Class...')
+    parser.add_option('-l', '--live',
+        action  = 'store',
+        dest    = 'live',
+        help    = 'Replay against host:port, a Unix socket path or @name instead of in-process',
+        default = None,
+    )
+    parser.add_option('-x', '--speed',
+        action  = 'store',
+        dest    = 'speed',
+        type    = 'float',
+        help    = 'Speed factor, 0 for as fast as possible [0]',
+        default = 0,
+    )
+    options, args = parser.parse_args()
+    if not args:
+        parser.error('missing transcript')
+    automatons = {}
+    for name in args[1:]:
+        module, cls = name.rsplit('.', 1)
+        automatons[name] = getattr(__import__(module), cls)
+    if options.live:
+        from loop import run
+        if os.sep in options.live or options.live.startswith('@'):
+            endpoint = options.live, None
+        else:
+            host, port = options.live.rsplit(':', 1)
+            endpoint = host.strip('[]'), int(port)
+        replay_live(args[0], endpoint, options.speed, automatons or None)
+        run()
+    else:
+        start = time.clock()
+        players = replay(args[0], automatons, options.speed)
+        sys.stdout.write('{0} connections replayed in {1:.3f}s CPU\n'.format(
+            len(players), time.clock() - start
+        ))
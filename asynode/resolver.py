@@ -0,0 +1,398 @@
+""" This module implements a non-blocking DNS stub resolver that runs on the
+asyncore loop. It answers ``MX``, ``A`` and ``AAAA`` questions through a
+shared TTL-respecting cache and coalesces identical in-flight questions, so
+that outbound delivery never waits on a blocking ``getaddrinfo``.
+
+Callbacks are called with *records* and *error*: on success *error* is
+``None``, on failure *records* is ``None`` and *error* a :class:`DNSError`.
+"""
+import asyncore
+import socket
+import struct
+import random
+import logging
+
+from cache import TTLCache
+from loop import call_later
+
+LOGGER = logging.getLogger('asynode.resolver')
+
+__all__ = (
+    'A',
+    'AAAA',
+    'MX',
+    'DNSError',
+    'Resolver',
+)
+
+A, CNAME, SOA, MX, AAAA = 1, 5, 6, 15, 28
+NOERROR, NXDOMAIN = 0, 3
+
+class DNSError(Exception):
+    pass
+
+
+def build_query(qid, name, qtype):
+    r""" Build a recursive query packet for ``name``.
+
+    >>> build_query(0x1234, 'work.it', MX)
+    '\x124\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x04work\x02it\x00\x00\x0f\x00\x01'
+    """
+    packet = struct.pack('!HHHHHH', qid, 0x0100, 1, 0, 0, 0)
+    for label in name.rstrip('.').split('.'):
+        if not 0 < len(label) < 64:
+            raise ValueError('label too long' if label else 'empty label')
+        packet += chr(len(label)) + label
+    return packet + '\0' + struct.pack('!HH', qtype, 1)
+
+def read_name(packet, offset):
+    r""" Read a possibly compressed domain name starting at ``offset``.
+    Return the name and the offset of the first byte after it.
+
+    >>> read_name('\x04work\x02it\x00\x02mx\xc0\x00', 9)
+    ('mx.work.it', 14)
+    """
+    labels, end = [], None
+    for _ in range(128):
+        length = ord(packet[offset])
+        if length & 0xc0 == 0xc0:
+            if end is None:
+                end = offset + 2
+            offset = struct.unpack('!H', packet[offset:offset+2])[0] & 0x3fff
+        elif length:
+            labels.append(packet[offset+1:offset+1+length])
+            offset += length + 1
+        else:
+            return '.'.join(labels), offset + 1 if end is None else end
+    raise DNSError('Name compression loop')
+
+def parse_response(packet):
+    """ Parse a response packet.
+
+    :returns: *qid*, *rcode*, the questions as ``(name, type)``, answer
+        records as ``(name, type, ttl, data)`` and the negative caching TTL
+        found in an ``SOA`` authority record.
+    """
+    qid, flags, qdcount, ancount, nscount, _ = struct.unpack(
+        '!HHHHHH', packet[:12]
+    )
+    offset = 12
+    questions = []
+    for _ in range(qdcount):
+        name, offset = read_name(packet, offset)
+        qtype = struct.unpack('!H', packet[offset:offset+2])[0]
+        questions.append((name.lower().rstrip('.'), qtype))
+        offset += 4
+    records, negative_ttl = [], None
+    for index in range(ancount + nscount):
+        name, offset = read_name(packet, offset)
+        rtype, _, ttl, rdlength = struct.unpack(
+            '!HHIH', packet[offset:offset+10]
+        )
+        offset += 10
+        rdata = packet[offset:offset+rdlength]
+        if rtype == A:
+            data = socket.inet_ntoa(rdata)
+        elif rtype == AAAA:
+            data = socket.inet_ntop(socket.AF_INET6, rdata)
+        elif rtype == MX:
+            data = (
+                struct.unpack('!H', rdata[:2])[0],
+                read_name(packet, offset + 2)[0],
+            )
+        elif rtype == CNAME:
+            data = read_name(packet, offset)[0]
+        elif rtype == SOA:
+            data = None
+            minimum = struct.unpack('!I', rdata[-4:])[0]
+            negative_ttl = min(ttl, minimum)
+        else:
+            data = rdata
+        offset += rdlength
+        if index < ancount:
+            records.append((name, rtype, ttl, data))
+    return qid, flags & 0xf, questions, records, negative_ttl
+
+def interleave(first, second):
+    """ Alternate the items of two lists.
+
+    >>> interleave(['::1', '::2'], ['1.1.1.1'])
+    ['::1', '1.1.1.1', '::2']
+    """
+    result = []
+    for index in range(max(len(first), len(second))):
+        result.extend(first[index:index+1] + second[index:index+1])
+    return result
+
+def same_address(first, second):
+    """ Compare two ``(address, port)`` pairs, whatever the spelling of
+    the addresses.
+
+    >>> same_address(('::1', 53), ('0::1', 53, 0, 0))
+    True
+    """
+    if first[1] != second[1]:
+        return False
+    family = socket.AF_INET6 if ':' in first[0] else socket.AF_INET
+    try:
+        return (socket.inet_pton(family, first[0])
+            == socket.inet_pton(family, second[0]))
+    except (socket.error, ValueError):
+        return False
+
+def read_nameservers(path='/etc/resolv.conf'):
+    """ Return the nameservers configured in ``path``. """
+    servers = []
+    try:
+        with open(path) as conf:
+            for line in conf:
+                fields = line.split()
+                if len(fields) > 1 and fields[0] == 'nameserver':
+                    servers.append(fields[1])
+    except (IOError, OSError):
+        pass
+    return servers or ['127.0.0.1']
+
+
+class Query(asyncore.dispatcher):
+    """ A single question sent over UDP, retried on timeout across the
+    resolver's nameservers.
+    """
+    def __init__(self, resolver, key):
+        asyncore.dispatcher.__init__(self)
+        self.resolver = resolver
+        self.key = key
+        self.qid = random.randint(0, 0xffff)
+        self.attempt = 0
+        self.timer = None
+        try:
+            self.packet = build_query(self.qid, key[0], key[1])
+        except ValueError as e:
+            self.fail(e)
+        else:
+            self.send_query()
+
+    def send_query(self):
+        try:
+            self._send_query()
+        except Exception as e:
+            self.fail(e)
+
+    def _send_query(self):
+        servers = self.resolver.nameservers
+        server = servers[self.attempt % len(servers)]
+        family = socket.AF_INET6 if ':' in server else socket.AF_INET
+        if self.socket is None or self.socket.family != family:
+            if self.socket is not None:
+                self.close()
+            self.create_socket(family, socket.SOCK_DGRAM)
+        self.server = server, self.resolver.port
+        self.socket.sendto(self.packet, self.server)
+        self.timer = call_later(self.resolver.timeout, self.handle_timeout)
+
+    def handle_timeout(self):
+        self.attempt += 1
+        if self.attempt > self.resolver.retries:
+            self.finish(None, DNSError('Timeout resolving {0}'.format(self.key)))
+        else:
+            LOGGER.debug('Retrying {q.key} ({q.attempt})'.format(q=self))
+            self.send_query()
+
+    def handle_read(self):
+        packet, sender = self.socket.recvfrom(65535)
+        if not same_address(self.server, sender):
+            LOGGER.warning('Ignoring answer from {0}'.format(sender))
+            return
+        try:
+            qid, rcode, questions, records, negative_ttl = parse_response(
+                packet
+            )
+        except (DNSError, struct.error, IndexError, ValueError) as e:
+            LOGGER.error(e)
+            return
+        if qid != self.qid or questions != [self.key]:
+            LOGGER.warning('Ignoring mismatched answer for {0}'.format(
+                self.key
+            ))
+            return
+        if rcode == NXDOMAIN:
+            self.finish(None, DNSError('{0} does not exist'.format(self.key[0])))
+        elif rcode != NOERROR:
+            self.finish(None, DNSError('{0} rcode {1}'.format(self.key, rcode)))
+        else:
+            answers = [r for r in records if r[1] == self.key[1]]
+            ttl = min([r[2] for r in answers] or [negative_ttl
+                if negative_ttl is not None else self.resolver.negative_ttl])
+            self.finish([r[3] for r in answers], None, ttl)
+
+    def fail(self, error):
+        LOGGER.error('Cannot query {0}: {1!r}'.format(self.key, error))
+        self.finish(None, DNSError('Query failed for {0}: {1}'.format(
+            self.key, error
+        )))
+
+    def finish(self, records, error, ttl=0):
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.socket is not None:
+            self.close()
+        self.resolver.resolved(self.key, records, error, ttl)
+
+    def writable(self):
+        return False
+
+    def handle_error(self):
+        LOGGER.exception('DNS query error')
+        self.finish(None, DNSError('Query failed for {0}'.format(self.key)))
+
+
+class Resolver(object):
+    """ Resolve names without blocking the loop.
+
+    :param nameservers: nameserver addresses, default from
+        ``/etc/resolv.conf``.
+    :type nameservers: :class:`list`
+    :param timeout: seconds to wait for each attempt.
+    :param retries: number of retries after the first attempt.
+    :param cache: shared cache of answers (default a new :class:`TTLCache`).
+    :type cache: :class:`cache.TTLCache`
+
+    >>> r = Resolver(nameservers=['127.0.0.1'])
+    >>> r.cache.set(('work.it', MX), [(20, 'mx2.work.it'), (10, 'mx1.work.it')])
+    >>> r.cache.set(('mx1.work.it', A), ['10.0.0.1'])
+    >>> r.cache.set(('mx1.work.it', AAAA), [])
+    >>> r.cache.set(('mx2.work.it', A), ['10.0.0.2'])
+    >>> r.cache.set(('mx2.work.it', AAAA), ['fd00::2'])
+    >>> def show(records, error): print(records)
+    >>> r.resolve_mx('Work.IT.', show)
+    ['mx1.work.it', 'mx2.work.it']
+    >>> r.resolve_endpoints('work.it', 25, show)
+    [('10.0.0.1', 25), ('fd00::2', 25), ('10.0.0.2', 25)]
+
+    Only answers from the queried nameserver to the question asked are
+    accepted. Against a stub nameserver, that first lets a spoofer answer
+    and then answers another question:
+
+    >>> from loop import run
+    >>> def response(query, name, address):
+    ...     header = query[:2] + struct.pack('!HHHHH', 0x8180, 1, 1, 0, 0)
+    ...     answer = '\xc0\x0c' + struct.pack('!HHIH', A, 1, 300, 4)
+    ...     return (header + build_query(0, name, A)[12:] + answer
+    ...         + socket.inet_aton(address))
+    >>> class Stub(asyncore.dispatcher):
+    ...     def __init__(self):
+    ...         asyncore.dispatcher.__init__(self)
+    ...         self.create_socket(socket.AF_INET, socket.SOCK_DGRAM)
+    ...         self.bind(('127.0.0.1', 0))
+    ...     def writable(self):
+    ...         return False
+    ...     def handle_read(self):
+    ...         query, peer = self.socket.recvfrom(512)
+    ...         spoofer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    ...         spoofer.sendto(response(query, 'work.it', '6.6.6.6'), peer)
+    ...         spoofer.close()
+    ...         self.socket.sendto(response(query, 'evil.it', '6.6.6.6'), peer)
+    ...         self.socket.sendto(response(query, 'work.it', '10.0.0.1'), peer)
+    ...         self.close()
+    >>> stub = Stub()
+    >>> r = Resolver(nameservers=['127.0.0.1'], port=stub.getsockname()[1])
+    >>> r.query('work.it', A, show); run(0.1)
+    ['10.0.0.1']
+    >>> r.cache.get(('work.it', A))
+    ['10.0.0.1']
+
+    Questions that cannot be sent fail at once:
+
+    >>> def report(records, error): print(error)
+    >>> r.query('bad..work.it', A, report)
+    Query failed for ('bad..work.it', 1): empty label
+    >>> r._inflight, [d for d in asyncore.socket_map.values() if isinstance(d, Query)]
+    ({}, [])
+    """
+    def __init__(self, nameservers=None, timeout=2.0, retries=2, **kwargs):
+        " Initialize a new :class:`Resolver`"
+        self.nameservers = nameservers or read_nameservers()
+        self.port = kwargs.get('port', 53)
+        self.timeout = timeout
+        self.retries = retries
+        self.negative_ttl = kwargs.get('negative_ttl', 60)
+        self.cache = kwargs.get('cache') or TTLCache(maxsize=4096)
+        self._inflight = {}
+
+    def query(self, name, qtype, callback):
+        """ Resolve records of ``qtype`` for ``name``. Identical questions
+        already in flight share a single query.
+        """
+        key = name.lower().rstrip('.'), qtype
+        records = self.cache.get(key)
+        if records is not None:
+            callback(records, None)
+        elif key in self._inflight:
+            self._inflight[key].append(callback)
+        else:
+            self._inflight[key] = [callback]
+            Query(self, key)
+
+    def resolved(self, key, records, error, ttl=0):
+        """ Cache an answer and notify every waiting callback. """
+        if error is None:
+            self.cache.set(key, records, ttl)
+        for callback in self._inflight.pop(key, ()):
+            callback(records, error)
+
+    def resolve_mx(self, domain, callback):
+        """ Resolve mail exchangers of ``domain`` ordered by preference.
+        A domain without ``MX`` records is its own exchanger.
+        """
+        def on_mx(records, error):
+            if error is not None:
+                return callback(None, error)
+            if not records:
+                return callback([domain.lower().rstrip('.')], None)
+            callback([host for _, host in sorted(records)], None)
+        self.query(domain, MX, on_mx)
+
+    def resolve_addresses(self, host, callback):
+        """ Resolve ``A`` and ``AAAA`` addresses of ``host`` in parallel.
+        Addresses of the two families are interleaved, IPv6 first.
+        """
+        answers = {}
+        def on_answer(qtype, records, error):
+            answers[qtype] = records or [], error
+            if len(answers) < 2:
+                return
+            addresses = interleave(answers[AAAA][0], answers[A][0])
+            if addresses:
+                callback(addresses, None)
+            else:
+                callback(None, answers[A][1] or answers[AAAA][1]
+                    or DNSError('{0} has no address'.format(host)))
+        self.query(host, A, lambda r, e: on_answer(A, r, e))
+        self.query(host, AAAA, lambda r, e: on_answer(AAAA, r, e))
+
+    def resolve_endpoints(self, domain, port, callback):
+        """ Resolve the ``(address, port)`` endpoints that accept mail for
+        ``domain``, most preferred first.
+        """
+        def on_mx(hosts, error):
+            if error is not None:
+                return callback(None, error)
+            results = [None] * len(hosts)
+            def on_addresses(index, addresses, error):
+                results[index] = addresses or [], error
+                if None in results:
+                    return
+                endpoints = [
+                    (address, port)
+                    for addresses, _ in results for address in addresses
+                ]
+                if endpoints:
+                    callback(endpoints, None)
+                else:
+                    callback(None, results[0][1])
+            for index, host in enumerate(hosts):
+                self.resolve_addresses(
+                    host,
+                    lambda a, e, index=index: on_addresses(index, a, e),
+                )
+        self.resolve_mx(domain, on_mx)
@@ -1,11 +1,209 @@
+import re
+import logging
+import threading
 from smtplib import CRLF, quotedata as qd
 from base64 import b64encode
 
 from state import State, Automaton
+from cache import TTLCache
+from futures import Future, ThreadPool, TimeoutError
+
+LOGGER = logging.getLogger('asynode.smtp')
 
 class AsyncSMTPException(Exception):
     pass
 
+class Raw(str):
+    """ A command pushed as is, without a trailing CRLF. """
+
+def fixeol(data):
+    """ Convert every line ending of ``data`` to CRLF. """
+    if data.count('\n') == data.count('\r') == data.count(CRLF):
+        return data
+    return re.sub(r'(?:\r\n|\n|\r(?!\n))', CRLF, data)
+
+class RecipientPolicy(object):
+    r'''
+    Validate recipients against an external store, caching both accepted
+    and rejected addresses.
+
+    :param lookup: called with a list of addresses, it returns a mapping
+        ``{address: accepted}``. Missing addresses are rejected.
+    :type lookup: callable
+    :param maxsize: maximum number of cached addresses.
+    :type maxsize: :class:`int`
+    :param ttl: seconds an accepted address stays cached.
+    :type ttl: :class:`float`
+    :param negative_ttl: seconds a rejected address stays cached.
+    :type negative_ttl: :class:`float`
+
+    >>> calls = []
+    >>> def lookup(addresses):
+    ...     calls.append(addresses)
+    ...     return dict((a, a.startswith('you')) for a in addresses)
+    >>> p = RecipientPolicy(lookup)
+    >>> p.check('you@work.it')
+    >>> p.validate(['you@work.it', 'nobody@work.it']) == {
+    ... 'you@work.it': True, 'nobody@work.it': False}
+    True
+    >>> p.check('You@Work.it'), p.check('nobody@work.it')
+    (True, False)
+    >>> p.validate(['you@work.it'])
+    {'you@work.it': True}
+    >>> calls
+    [['you@work.it', 'nobody@work.it']]
+
+    :meth:`resolve` runs the lookup in an executor, coalescing the addresses
+    requested while another lookup is in flight:
+
+    >>> from futures import ThreadPool
+    >>> pool = ThreadPool(1)
+    >>> p = RecipientPolicy(lookup)
+    >>> p.resolve(['they@work.it', 'you@work.it'], pool).result(timeout=1) == {
+    ... 'they@work.it': False, 'you@work.it': True}
+    True
+    >>> pool.shutdown()
+    '''
+    def __init__(self, lookup, maxsize=4096, ttl=300, negative_ttl=60):
+        self.lookup = lookup
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self._waiting = []
+        self._busy = False
+
+    def check(self, address):
+        """ Return the cached verdict for ``address``, ``None`` if unknown. """
+        with self._lock:
+            return self._cache.get(address.lower())
+
+    def validate(self, addresses):
+        """ Return a verdict for every address. Addresses missing from the
+        cache are resolved with a single ``lookup`` call.
+        """
+        verdict, missing = {}, []
+        for address in addresses:
+            known = self.check(address)
+            if known is None:
+                missing.append(address)
+            else:
+                verdict[address] = known
+        if missing:
+            found = self.lookup(missing)
+            for address in missing:
+                accepted = bool(found.get(address))
+                with self._lock:
+                    self._cache.set(
+                        address.lower(), accepted,
+                        self.ttl if accepted else self.negative_ttl,
+                    )
+                verdict[address] = accepted
+        return verdict
+
+    def resolve(self, addresses, executor):
+        """ Validate ``addresses`` in ``executor``. Addresses requested
+        before the lookup starts share a single ``lookup`` call.
+
+        :rtype: :class:`futures.Future` of the verdicts, as
+            :meth:`validate`
+        """
+        future = Future()
+        with self._lock:
+            self._waiting.append((addresses, future))
+            if self._busy:
+                return future
+            self._busy = True
+        executor.submit(self._drain)
+        return future
+
+    def _drain(self):
+        while True:
+            with self._lock:
+                waiting, self._waiting = self._waiting, []
+                if not waiting:
+                    self._busy = False
+                    return
+            addresses = []
+            for wanted, _ in waiting:
+                addresses.extend(a for a in wanted if a not in addresses)
+            try:
+                verdict = self.validate(addresses)
+            except Exception as e:
+                for _, future in waiting:
+                    future.set_exception(e)
+                continue
+            for wanted, future in waiting:
+                future.set_result(dict((a, verdict[a]) for a in wanted))
+
+
+class Lookup(Future):
+    """ Future of the reply to a ``RCPT`` whose recipient is not cached.
+
+    The recipients of the ``RCPT`` commands already read behind it, given to
+    :meth:`lookahead`, are looked up in the same batch. The lookup starts
+    when the future is first waited on. The reply is built, and the
+    automaton updated, by the first :meth:`result` call, so on the thread
+    driving the automaton rather than in the executor.
+    """
+    def __init__(self, automaton, address):
+        super(Lookup, self).__init__()
+        self.automaton = automaton
+        self.address = address
+        self.addresses = [address]
+        self._started = False
+        self._reply = None
+
+    def lookahead(self, data):
+        """ Add the recipients of the pipelined ``RCPT`` in ``data``. """
+        policy = self.automaton.policy
+        for line in data.split(CRLF)[:-1]:
+            command, _, arg = line.partition(' ')
+            if command.lower() != 'rcpt':
+                break
+            address, params = self.automaton.rcptaddr(arg)
+            if (address and not params and address not in self.addresses
+                    and policy.check(address) is None):
+                self.addresses.append(address)
+
+    def _start(self):
+        if self._started:
+            return
+        self._started = True
+        self.automaton.policy.resolve(
+            self.addresses, self.automaton.context.executor
+        ).add_done_callback(self._resolved)
+
+    def _resolved(self, future):
+        error = future.exception()
+        if error is not None:
+            self.set_exception(error)
+        else:
+            self.set_result(future.result())
+
+    def add_done_callback(self, callback):
+        self._start()
+        super(Lookup, self).add_done_callback(callback)
+
+    def result(self, timeout=None):
+        self._start()
+        try:
+            verdict = super(Lookup, self).result(timeout)
+        except TimeoutError:
+            raise
+        except Exception:
+            LOGGER.exception('Recipient lookup failed')
+            return self.automaton.reply(
+                '451 Requested action aborted: local error in processing'
+            )
+        with self._condition:
+            if self._reply is None:
+                self._reply = self.automaton._accept(
+                    self.address, verdict[self.address]
+                )
+            return self._reply
+
+
 class SMTPOutcomingAutomaton(Automaton):
     r'''
     >>> s = SMTPOutcomingAutomaton(
@@ -28,63 +226,131 @@ class SMTPOutcomingAutomaton(Automaton):
     ... ]
     True
     >>> s.next(None, 'INITIAL') #INIT
-    State(push=None, terminator='\r\n', close=False, final=False)
+    State(push=None, terminator='\r\n', close=False, final=False, maxline=None, maxbuffer=None)
     >>> s.next(None) #CONNECT
-    State(push=None, terminator=None, close=False, final=False)
+    State(push=None, terminator=None, close=False, final=False, maxline=None, maxbuffer=None)
     >>> s.next('220') #ACK CONNECT
-    State(push='AUTH PLAIN AHVzZXIAcGFzcw==\r\n', terminator=None, close=False, final=False)
+    State(push='AUTH PLAIN AHVzZXIAcGFzcw==\r\n', terminator=None, close=False, final=False, maxline=None, maxbuffer=None)
     >>> s.next('235') #ACK AUTH
-    State(push='HELO @work\r\n', terminator=None, close=False, final=False)
+    State(push='HELO @work\r\n', terminator=None, close=False, final=False, maxline=None, maxbuffer=None)
     >>> s.next('250') #ACK HELO
-    State(push='MAIL FROM: <me@work.it>\r\n', terminator=None, close=False, final=False)
+    State(push='MAIL FROM: <me@work.it>\r\n', terminator=None, close=False, final=False, maxline=None, maxbuffer=None)
     >>> s.next('250') #ACK MAIL
-    State(push='RCPT TO: <you@work.it>\r\n', terminator=None, close=False, final=False)
+    State(push='RCPT TO: <you@work.it>\r\n', terminator=None, close=False, final=False, maxline=None, maxbuffer=None)
     >>> s.next('250') #ACK RCPT_1
-    State(push='RCPT TO: <us@work.it>\r\n', terminator=None, close=False, final=False)
+    State(push='RCPT TO: <us@work.it>\r\n', terminator=None, close=False, final=False, maxline=None, maxbuffer=None)
     >>> s.next('250') #ACK RCPT_2
-    State(push='DATA\r\n', terminator=None, close=False, final=False)
+    State(push='DATA\r\n', terminator=None, close=False, final=False, maxline=None, maxbuffer=None)
     >>> s.next('354') #ACK DATA
-    State(push='Hello World!\r\nHello Again!\r\n.\r\n', terminator=None, close=False, final=False)
+    State(push='Hello World!\r\nHello Again!\r\n.\r\n', terminator=None, close=False, final=False, maxline=None, maxbuffer=None)
     >>> s.next('250') #ACK SENDDATA
-    State(push='QUIT\r\n', terminator=None, close=False, final=False)
+    State(push='QUIT\r\n', terminator=None, close=False, final=False, maxline=None, maxbuffer=None)
     >>> s.next('221') #ACK QUIT
-    State(push=None, terminator=None, close=False, final=True)
+    State(push=None, terminator=None, close=False, final=True, maxline=None, maxbuffer=None)
+
+    With ``esmtp`` the automaton greets with ``EHLO`` and, when the server
+    supports ``CHUNKING``, sends the message in ``BDAT`` chunks without
+    dot-stuffing it:
+
+    >>> s = SMTPOutcomingAutomaton(
+    ...     localname = '@work',
+    ...     source = 'me@work.it',
+    ...     targets = ['you@work.it'],
+    ...     message = 'Hello World!\nHello Again!',
+    ...     esmtp = True,
+    ... )
+    >>> _ = s.next(None, 'INITIAL'), s.next(None)
+    >>> s.next('220').push
+    'EHLO @work\r\n'
+    >>> s.next('250-z4r.buongiorno.loc')
+    State(push=None, terminator=None, close=False, final=False, maxline=None, maxbuffer=None)
+    >>> _ = s.next('250-8BITMIME')
+    >>> s.next('250 CHUNKING').push
+    'MAIL FROM: <me@work.it> BODY=8BITMIME\r\n'
+    >>> s.next('250').push
+    'RCPT TO: <you@work.it>\r\n'
+    >>> s.next('250').push
+    'BDAT 28 LAST\r\nHello World!\r\nHello Again!\r\n'
+    >>> s.next('250').push
+    'QUIT\r\n'
     '''
-    def __init__(self, source, targets, message, localname, auth=None):
+    def __init__(self, source, targets, message, localname, auth=None,
+            esmtp=False, chunk_size=None):
         super(SMTPOutcomingAutomaton, self).__init__()
+        self._source = source
+        self._targets = targets
+        self._message = message
+        self._chunk_size = chunk_size
+        self._esmtp = esmtp
+        self.extensions = {}
         self._indata = [(None, '220')]
         if auth:
             self._indata.append((
                 'AUTH PLAIN ' + b64encode(("\0%s\0%s") % auth),
                 '235',
                 ))
-        self._indata.append(self._helo(localname))
-        self._indata.append(self._mail(source))
-        self._indata.extend(self._rcpt(targets))
-        self._indata.append(self._data())
-        self._indata.append(self._qmsg(message))
-        self._indata.append(self._quit())
+        self._greeting = self._ehlo(localname) if esmtp else self._helo(localname)
+        self._indata.append(self._greeting)
+        if not esmtp:
+            self._indata.extend(self._transaction())
         self._nextcheck = None
+        self._sent = None
+        self._lines = []
 
     def initial(self, data):
         return State.get_push(terminator=CRLF)
 
     def operative(self, data):
+        if data and data[3:4] == '-':
+            self._lines.append(data)
+            return State.get_push()
+        lines, self._lines = self._lines + [data], []
         self._check(data, self._nextcheck)
+        if self._esmtp and self._sent == self._greeting[0]:
+            self._negotiate(lines)
         try:
             push, self._nextcheck = self._indata.pop(0)
-            if push is not None:
+            self._sent = push
+            if push is not None and not isinstance(push, Raw):
                 push += CRLF
             return State.get_push(push=push)
         except IndexError:
             return State.get_final()
 
+    def _negotiate(self, lines):
+        """ Read the extensions announced in the ``EHLO`` reply and plan the
+        transaction accordingly.
+        """
+        for line in lines[1:]:
+            keyword, _, params = line[4:].partition(' ')
+            self.extensions[keyword.upper()] = params
+        self._indata = list(self._transaction())
+
+    def _transaction(self):
+        body = '8BITMIME' if '8BITMIME' in self.extensions else None
+        yield self._mail(self._source, body)
+        for rcpt in self._rcpt(self._targets):
+            yield rcpt
+        if 'CHUNKING' in self.extensions:
+            for chunk in self._bdat(self._message, self._chunk_size):
+                yield chunk
+        else:
+            yield self._data()
+            yield self._qmsg(self._message)
+        yield self._quit()
+
     @staticmethod
     def _helo(localname):
         return 'HELO {0}'.format(localname), '250'
 
     @staticmethod
-    def _mail(source):
+    def _ehlo(localname):
+        return 'EHLO {0}'.format(localname), '250'
+
+    @staticmethod
+    def _mail(source, body=None):
+        if body:
+            return 'MAIL FROM: <{0}> BODY={1}'.format(source, body), '250'
         return 'MAIL FROM: <{0}>'.format(source), '250'
 
     @staticmethod
@@ -104,6 +370,17 @@ class SMTPOutcomingAutomaton(Automaton):
         message += "."
         return str(message), '250'
 
+    @staticmethod
+    def _bdat(message, chunk_size=None):
+        message = str(fixeol(message))
+        if not message.endswith(CRLF):
+            message += CRLF
+        chunk_size = chunk_size or len(message)
+        for offset in range(0, len(message), chunk_size):
+            chunk = message[offset:offset + chunk_size]
+            last = ' LAST' if offset + chunk_size >= len(message) else ''
+            yield Raw('BDAT {0}{1}{2}{3}'.format(len(chunk), last, CRLF, chunk)), '250'
+
     @staticmethod
     def _quit():
         return 'QUIT', '221'
@@ -115,57 +392,238 @@ class SMTPOutcomingAutomaton(Automaton):
             raise AsyncSMTPException(data)
 
 import socket
+class SMTPContext(object):
+    r'''
+    State shared by every :class:`SMTPIncomingAutomaton` of a factory. It is
+    computed once, so that accepting a connection does no blocking lookup.
+
+    :param fqdn: name announced in replies (default :func:`socket.getfqdn`).
+    :type fqdn: :class:`str`
+    :param version: version announced in the banner.
+    :type version: :class:`str`
+    :param policy: recipient policy.
+    :type policy: :class:`RecipientPolicy`
+    :param executor: pool running the policy lookups off the loop, e.g. a
+        :class:`futures.ThreadPool`. With a policy it defaults to a pool
+        shared by every context; ``False`` looks recipients up on the loop.
+    :param maxline: maximum length of a command line.
+    :type maxline: :class:`int`
+    :param maxsize: maximum size of a message.
+    :type maxsize: :class:`int`
+
+    >>> c = SMTPContext(fqdn='z4r.buongiorno.loc')
+    >>> c.banner
+    State(push='220 z4r.buongiorno.loc 1.0\r\n', terminator='\r\n', close=False, final=False, maxline=1000, maxbuffer=None)
+    >>> c.reply('250 Ok') is c.reply('250 Ok')
+    True
+    '''
+    maxreplies = 256
+    shared_executor = None
+
+    def __init__(self, fqdn=None, version='1.0', policy=None, executor=None,
+            maxline=1000, maxsize=10 * 1024 * 1024):
+        self.fqdn = fqdn or socket.getfqdn()
+        self.version = version
+        self.policy = policy
+        if policy is not None and executor is None:
+            if SMTPContext.shared_executor is None:
+                SMTPContext.shared_executor = ThreadPool()
+            executor = SMTPContext.shared_executor
+        self.executor = executor
+        self.maxline = maxline
+        self.maxsize = maxsize
+        self.banner = State.get_push(
+            '220 {s.fqdn} {s.version}{0}'.format(CRLF, s=self), CRLF, maxline
+        )
+        self.extensions = self.announce(['8BITMIME', 'CHUNKING'])
+        self.replies = {}
+
+    def announce(self, keywords):
+        """ Return the ``EHLO`` reply announcing ``keywords`` and ``SIZE``. """
+        return CRLF.join(
+            ['250-' + self.fqdn]
+            + ['250-' + keyword for keyword in keywords]
+            + ['250 SIZE {0}'.format(self.maxsize)]
+        )
+
+    def reply(self, message, terminator=None, maxline=None):
+        """ Return the reply :class:`State`, shared among automatons. """
+        key = message, terminator, maxline
+        try:
+            return self.replies[key]
+        except KeyError:
+            state = State.get_push(message + CRLF, terminator, maxline)
+            if len(self.replies) < self.maxreplies:
+                self.replies[key] = state
+            return state
+
+
 class SMTPIncomingAutomaton(Automaton):
     r'''
     >>> s = SMTPIncomingAutomaton(fqdn='z4r.buongiorno.loc')
     >>> s.next(None, 'INITIAL')
-    State(push='220 z4r.buongiorno.loc 1.0\r\n', terminator='\r\n', close=False, final=False)
+    State(push='220 z4r.buongiorno.loc 1.0\r\n', terminator='\r\n', close=False, final=False, maxline=1000, maxbuffer=None)
     >>> s.next('LHLO')
-    State(push="502 Error: command 'lhlo' not implemented\r\n", terminator=None, close=False, final=False)
+    State(push="502 Error: command 'lhlo' not implemented\r\n", terminator=None, close=False, final=False, maxline=None, maxbuffer=None)
     >>> s.next('HELO')
-    State(push='501 Syntax: HELO hostname\r\n', terminator=None, close=False, final=False)
+    State(push='501 Syntax: HELO hostname\r\n', terminator=None, close=False, final=False, maxline=None, maxbuffer=None)
     >>> s.next('HELO @work')
-    State(push='250 z4r.buongiorno.loc\r\n', terminator=None, close=False, final=False)
+    State(push='250 z4r.buongiorno.loc\r\n', terminator=None, close=False, final=False, maxline=None, maxbuffer=None)
     >>> s.next('HELO @work')
-    State(push='503 Duplicate HELO/EHLO\r\n', terminator=None, close=False, final=False)
+    State(push='503 Duplicate HELO/EHLO\r\n', terminator=None, close=False, final=False, maxline=None, maxbuffer=None)
     >>> s.next('RCPT TO: <you@work.it>')
-    State(push='503 Error: need MAIL command\r\n', terminator=None, close=False, final=False)
+    State(push='503 Error: need MAIL command\r\n', terminator=None, close=False, final=False, maxline=None, maxbuffer=None)
     >>> s.next('MAIL FROM: ')
-    State(push='501 Syntax: MAIL FROM:<address>\r\n', terminator=None, close=False, final=False)
+    State(push='501 Syntax: MAIL FROM:<address>\r\n', terminator=None, close=False, final=False, maxline=None, maxbuffer=None)
     >>> s.next('MAIL FROM: <me@work.it>')
-    State(push='250 Ok\r\n', terminator=None, close=False, final=False)
+    State(push='250 Ok\r\n', terminator=None, close=False, final=False, maxline=None, maxbuffer=None)
     >>> s.next('MAIL FROM: <me@work.it>')
-    State(push='503 Error: nested MAIL command\r\n', terminator=None, close=False, final=False)
+    State(push='503 Error: nested MAIL command\r\n', terminator=None, close=False, final=False, maxline=None, maxbuffer=None)
     >>> s.next('DATA')
-    State(push='503 Error: need RCPT command\r\n', terminator=None, close=False, final=False)
+    State(push='503 Error: need RCPT command\r\n', terminator=None, close=False, final=False, maxline=None, maxbuffer=None)
     >>> s.next('RCPT TO: <you@work.it>')
-    State(push='250 Ok\r\n', terminator=None, close=False, final=False)
+    State(push='250 Ok\r\n', terminator=None, close=False, final=False, maxline=None, maxbuffer=None)
     >>> s.next('RCPT TO: <us@work.it>')
-    State(push='250 Ok\r\n', terminator=None, close=False, final=False)
+    State(push='250 Ok\r\n', terminator=None, close=False, final=False, maxline=None, maxbuffer=None)
     >>> s.next('DATA SEND')
-    State(push='501 Syntax: DATA\r\n', terminator=None, close=False, final=False)
+    State(push='501 Syntax: DATA\r\n', terminator=None, close=False, final=False, maxline=None, maxbuffer=None)
     >>> s.next('DATA')
-    State(push='354 End data with <CR><LF>.<CR><LF>\r\n', terminator='\r\n.\r\n', close=False, final=False)
-    >>> s.next('Hello World!\r\nHello Again!')
-    State(push='250 Ok\r\n', terminator='\r\n', close=False, final=False)
+    State(push='354 End data with <CR><LF>.<CR><LF>\r\n', terminator='\r\n.\r\n', close=False, final=False, maxline=10485760, maxbuffer=None)
+    >>> s.next('Hello World!\r\n..Hello Again!')
+    State(push='250 Ok\r\n', terminator='\r\n', close=False, final=False, maxline=1000, maxbuffer=None)
+    >>> s._indata
+    'Hello World!\r\n.Hello Again!\r\n'
     >>> s.next('QUIT')
-    State(push='221 Bye', terminator=None, close=True, final=True)
+    State(push='221 Bye', terminator=None, close=True, final=True, maxline=None, maxbuffer=None)
+
+    Lines longer than the limits of the context are an ``ERROR``, reported
+    with ``None`` by :class:`core.Connection`:
+
+    >>> s = SMTPIncomingAutomaton(fqdn='z4r.buongiorno.loc')
+    >>> s.next(None, 'ERROR').push
+    '500 Line too long\r\n'
+    >>> s._command = False
+    >>> s.next(None, 'ERROR')
+    State(push='552 Message size exceeds fixed maximum message size\r\n', terminator=None, close=True, final=True, maxline=None, maxbuffer=None)
+
+    Automatons of a factory usually share a :class:`SMTPContext`:
+
+    >>> c = SMTPContext(fqdn='z4r.buongiorno.loc')
+    >>> s = SMTPIncomingAutomaton(context=c)
+    >>> s.next(None, 'INITIAL') is SMTPIncomingAutomaton(context=c).next(None, 'INITIAL')
+    True
+
+    With a :class:`RecipientPolicy`, cached verdicts are answered at once
+    while unknown recipients are looked up off the loop: ``RCPT`` returns a
+    future of the reply, so that no recipient is accepted unverified.
+    Pipelined ``RCPT`` of concurrent sessions share a lookup:
+
+    >>> p = RecipientPolicy(lambda a: {'you@work.it': True})
+    >>> p.validate(['nobody@work.it']) == {'nobody@work.it': False}
+    True
+    >>> s = SMTPIncomingAutomaton(fqdn='z4r.buongiorno.loc', policy=p)
+    >>> s.next('MAIL FROM: <me@work.it>').push
+    '250 Ok\r\n'
+    >>> s.next('RCPT TO: <nobody@work.it>').push
+    '550 No such user here\r\n'
+    >>> s.next('RCPT TO: <us@work.it>').result(timeout=1).push
+    '550 No such user here\r\n'
+    >>> s.next('DATA').push
+    '503 Error: need RCPT command\r\n'
+    >>> s.next('RCPT TO: <you@work.it>').result(timeout=1).push
+    '250 Ok\r\n'
+    >>> s.next('DATA').push
+    '354 End data with <CR><LF>.<CR><LF>\r\n'
+    >>> s._rcpttos
+    ['you@work.it']
+
+    The recipients of pipelined ``RCPT`` commands are looked up together,
+    and the replies follow in order:
+
+    >>> from replay import Player
+    >>> lookups = []
+    >>> def lookup(addresses):
+    ...     lookups.append(addresses)
+    ...     return {'b@w.it': True}
+    >>> c = SMTPContext(fqdn='z4r.buongiorno.loc', policy=RecipientPolicy(lookup))
+    >>> player = Player(SMTPIncomingAutomaton(context=c))
+    >>> player.feed('MAIL FROM:<me@work.it>\r\nRCPT TO:<a@w.it>\r\n'
+    ...     'RCPT TO:<b@w.it>\r\nRCPT TO:<c@w.it>\r\nDATA\r\n')
+    >>> lookups
+    [['a@w.it', 'b@w.it', 'c@w.it']]
+    >>> [push[:3] for push in player.sent[1:]]
+    ['250', '550', '250', '550', '354']
+    >>> player.automaton._rcpttos
+    ['b@w.it']
+
+    With ``executor=False`` the lookup blocks the loop:
+
+    >>> c = SMTPContext(fqdn='z4r.buongiorno.loc', policy=p, executor=False)
+    >>> s = SMTPIncomingAutomaton(context=c)
+    >>> s.next('MAIL FROM: <me@work.it>').push
+    '250 Ok\r\n'
+    >>> s.next('RCPT TO: <they@work.it>').push
+    '550 No such user here\r\n'
+
+    ``EHLO`` announces ``8BITMIME``, ``SIZE`` and ``CHUNKING``: ``BDAT``
+    chunks are read as they are, without looking for the end of data:
+
+    >>> s = SMTPIncomingAutomaton(fqdn='z4r.buongiorno.loc')
+    >>> s.next('EHLO @work').push.split(CRLF)
+    ['250-z4r.buongiorno.loc', '250-8BITMIME', '250-CHUNKING', '250 SIZE 10485760', '']
+    >>> s.next('MAIL FROM:<me@work.it> SIZE=20971520').push
+    '552 Message size exceeds fixed maximum message size\r\n'
+    >>> s.next('MAIL FROM:<me@work.it> BODY=BINARYMIME').push
+    '555 MAIL FROM/RCPT TO parameters not recognized or not implemented\r\n'
+    >>> s.next('MAIL FROM:<me@work.it> BODY=8BITMIME SIZE=28').push
+    '250 Ok\r\n'
+    >>> s.next('RCPT TO:<you@work.it>').push
+    '250 Ok\r\n'
+    >>> s.next('BDAT 14')
+    State(push=None, terminator=14, close=False, final=False, maxline=None, maxbuffer=10485760)
+    >>> s.next('Hello World!\r\n').push
+    '250 Ok\r\n'
+    >>> s.next('BDAT 14 LAST')
+    State(push=None, terminator=14, close=False, final=False, maxline=None, maxbuffer=10485746)
+    >>> s.next('Hello Again!\r\n')
+    State(push='250 Ok\r\n', terminator='\r\n', close=False, final=False, maxline=1000, maxbuffer=None)
+    >>> s._indata
+    'Hello World!\r\nHello Again!\r\n'
+
+    A chunk that would exceed the maximum message size is refused before
+    it is read:
+
+    >>> _ = s.next('RSET'), s.next('MAIL FROM:<me@work.it>')
+    >>> s.next('RCPT TO:<you@work.it>').push
+    '250 Ok\r\n'
+    >>> s.next('BDAT 20971520 LAST')
+    State(push='552 Message size exceeds fixed maximum message size\r\n', terminator=None, close=True, final=True, maxline=None, maxbuffer=None)
     '''
     def __init__(self, *args, **kwargs):
         super(SMTPIncomingAutomaton, self).__init__()
-        self.fqdn = kwargs.get('fqdn', socket.getfqdn())
-        self.version = kwargs.get('version', '1.0')
+        context = kwargs.get('context')
+        if context is None:
+            context = SMTPContext(
+                kwargs.get('fqdn'), kwargs.get('version', '1.0'),
+                kwargs.get('policy'),
+            )
+        self.context = context
+        self.fqdn = context.fqdn
+        self.version = context.version
+        self.policy = context.policy
+        self.reply = context.reply
         self._command = True
         self._indata = ''
         self._greeting = False
         self._mailfrom = None
         self._rcpttos = []
+        self._body = None
+        self._chunks = None
+        self._last = False
+        self._received = 0
 
     def initial(self, data):
-        return self.reply(
-            message='220 {s.fqdn} {s.version}'.format(s=self),
-            terminator=CRLF,
-        )
+        return self.context.banner
 
     def operative(self, data):
         if self._command:
@@ -180,18 +638,30 @@ class SMTPIncomingAutomaton(Automaton):
             if not method:
                 return self.not_implemented(command)
             return method(arg)
+        elif self._chunks is not None:
+            return self._chunk(data)
         else:
             return self._qmsg(data)
 
+    def error(self, data):
+        if data is not None:
+            message = '451 Requested action aborted: local error in processing'
+        elif self._command:
+            message = '500 Line too long'
+        else:
+            message = '552 Message size exceeds fixed maximum message size'
+        return State.get_final(push=message + CRLF, close=True)
+
     def _qmsg(self, arg):
         indata = []
         for text in arg.split(CRLF):
             if text and text[0] == '.':
                 text = text[1:]
-            indata.append(text[1:])
-        self._indata = '\n'.join(indata)
+            indata.append(text)
+        indata.append('')
+        self._indata = CRLF.join(indata)
         self._command = True
-        return self.reply('250 Ok', CRLF)
+        return self.reply('250 Ok', CRLF, self.context.maxline)
 
     def _helo(self, arg):
         if not arg:
@@ -201,21 +671,65 @@ class SMTPIncomingAutomaton(Automaton):
         self._greeting = arg
         return self.reply('250 {s.fqdn}'.format(s=self))
 
+    def _ehlo(self, arg):
+        if not arg:
+            return self.reply('501 Syntax: EHLO hostname')
+        if self._greeting:
+            return self.reply('503 Duplicate HELO/EHLO')
+        self._greeting = arg
+        return self.reply(self.context.extensions)
+
     def _mail(self, arg):
+        arg, params = self.splitparams(arg) if arg else (None, {})
         address = self.cleanaddr('FROM:', arg) if arg else None
         if not address:
             return self.reply('501 Syntax: MAIL FROM:<address>')
         if self._mailfrom:
             return self.reply('503 Error: nested MAIL command')
+        body = params.pop('BODY', '7BIT').upper()
+        size = params.pop('SIZE', '0')
+        if params or body not in ('7BIT', '8BITMIME') or not size.isdigit():
+            return self.reply(
+                '555 MAIL FROM/RCPT TO parameters not recognized or not implemented'
+            )
+        if int(size) > self.context.maxsize:
+            return self.reply(
+                '552 Message size exceeds fixed maximum message size'
+            )
         self._mailfrom = address
+        self._body = body
         return self.reply('250 Ok')
 
     def _rcpt(self, arg):
         if not self._mailfrom:
             return self.reply('503 Error: need MAIL command')
-        address = self.cleanaddr('TO:', arg) if arg else None
+        address, params = self.rcptaddr(arg)
         if not address:
             return self.reply('501 Syntax: RCPT TO: <address>')
+        if params:
+            return self.reply(
+                '555 MAIL FROM/RCPT TO parameters not recognized or not implemented'
+            )
+        if self.policy is None:
+            return self._accept(address, True)
+        known = self.policy.check(address)
+        if known is not None:
+            return self._accept(address, known)
+        if not self.context.executor:
+            return self._accept(
+                address, self.policy.validate([address])[address]
+            )
+        return Lookup(self, address)
+
+    @classmethod
+    def rcptaddr(cls, arg):
+        """ Return the address and the parameters of a ``RCPT`` argument. """
+        arg, params = cls.splitparams(arg) if arg else (None, {})
+        return cls.cleanaddr('TO:', arg) if arg else None, params
+
+    def _accept(self, address, accepted):
+        if not accepted:
+            return self.reply('550 No such user here')
         self._rcpttos.append(address)
         return self.reply('250 Ok')
 
@@ -224,8 +738,49 @@ class SMTPIncomingAutomaton(Automaton):
             return self.reply('503 Error: need RCPT command')
         if arg:
             return self.reply('501 Syntax: DATA')
+        if self._chunks is not None:
+            return self.reply('503 Error: BDAT in progress')
+        self._command = False
+        return self.reply(
+            '354 End data with <CR><LF>.<CR><LF>', CRLF+'.'+CRLF,
+            self.context.maxsize,
+        )
+
+    def _bdat(self, arg):
+        """ Receive a ``BDAT`` chunk as is, without scanning it. The whole
+        message is bounded by the ``maxsize`` of the context.
+        """
+        args = arg.split() if arg else []
+        if (not 0 < len(args) < 3 or not args[0].isdigit()
+                or [a.upper() for a in args[1:]] not in ([], ['LAST'])):
+            return self.reply('501 Syntax: BDAT chunk-size [LAST]')
+        if not self._rcpttos:
+            return self.reply('503 Error: need RCPT command')
+        if self._chunks is None:
+            self._chunks, self._received = [], 0
+        self._last = len(args) == 2
+        size = int(args[0])
+        if size > self.context.maxsize - self._received:
+            return State.get_final(
+                push='552 Message size exceeds fixed maximum message size'
+                + CRLF, close=True,
+            )
+        if not size:
+            return self._chunk('')
         self._command = False
-        return self.reply('354 End data with <CR><LF>.<CR><LF>', CRLF+'.'+CRLF)
+        return State.get_push(
+            terminator=size, maxbuffer=self.context.maxsize - self._received
+        )
+
+    def _chunk(self, data):
+        self._command = True
+        self._chunks.append(data)
+        self._received += len(data)
+        if not self._last:
+            return self.reply('250 Ok', CRLF, self.context.maxline)
+        self._indata = ''.join(self._chunks)
+        self._chunks = None
+        return self.reply('250 Ok', CRLF, self.context.maxline)
 
     def _quit(self, arg):
         return State.get_final(push='221 Bye', close=True)
@@ -238,10 +793,22 @@ class SMTPIncomingAutomaton(Automaton):
             return self.reply('501 Syntax: RSET')
         self._mailfrom = None
         self._rcpttos = []
+        self._body = None
+        self._chunks = None
         self._indata = ''
         self._command = True
         return self.reply('250 Ok')
 
+    @staticmethod
+    def splitparams(arg):
+        """ Split the ESMTP parameters off a ``MAIL`` or ``RCPT`` argument. """
+        end = arg.find('>') + 1 or len(arg)
+        params = {}
+        for param in arg[end:].split():
+            key, _, value = param.partition('=')
+            params[key.upper()] = value
+        return arg[:end], params
+
     @staticmethod
     def cleanaddr(keyword, arg):
         address = None
@@ -255,8 +822,8 @@ class SMTPIncomingAutomaton(Automaton):
         return address
 
     @staticmethod
-    def reply(message, terminator=None):
-        return State.get_push(message + CRLF, terminator)
+    def reply(message, terminator=None, maxline=None):
+        return State.get_push(message + CRLF, terminator, maxline)
 
     @classmethod
     def not_implemented(cls, command):
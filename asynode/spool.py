@@ -0,0 +1,492 @@
+""" This module implements a durable outbound queue.
+
+Messages are appended to segment files and tracked by a memory-mapped
+index. Enqueued messages are made durable in groups, with one ``fsync`` per
+batch, and are handed to a :class:`core.ConnectionFactory` only once they
+are on disk. After a crash, :meth:`Spool.redrive` sends again every message
+whose delivery was not acknowledged.
+
+Delivery is *at least once*: a message delivered right before a crash, but
+not yet acknowledged on disk, is sent again. A message failing more than
+``attempts`` times, or for longer than ``expire`` seconds, is given up.
+
+Entries of released messages are dropped from the index as soon as they
+fill half of it, whatever the age of the messages still pending.
+"""
+import os
+import mmap
+import time
+import zlib
+import struct
+import logging
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from state import State, Automaton
+from loop import call_later
+
+LOGGER = logging.getLogger('asynode.spool')
+
+__all__ = (
+    'Spool',
+    'SpoolError',
+)
+
+MAGIC = 'ASYSPOOL'
+HEADER = struct.Struct('!8sQQ')
+ENTRY = struct.Struct('!QIQIIBB2x')
+RECORD = struct.Struct('!QII')
+PENDING, DONE, FAILED = 0, 1, 2
+
+class SpoolError(Exception):
+    pass
+
+
+class SpooledAutomaton(Automaton):
+    """ Wrap an outcoming break point handler and acknowledge its message
+    on the spool when it reaches a final state. The delivery is retried on
+    ``ERROR``, when the handler raises or when the connection closes first.
+    Exceptions with a true ``permanent`` attribute give the message up.
+    """
+    def __init__(self, spool, eid, automaton):
+        self.spool = spool
+        self.eid = eid
+        self.automaton = automaton
+        self.settled = False
+
+    def next(self, data, state='OPERATIVE'):
+        if state == 'ERROR':
+            self._settle(self.spool.retry)
+            return State.get_final(close=True)
+        try:
+            next_state = self.automaton.next(data, state)
+        except Exception as e:
+            LOGGER.warning('Delivery of {0} failed: {1!r}'.format(self.eid, e))
+            if getattr(e, 'permanent', False):
+                self._settle(self.spool.fail)
+            else:
+                self._settle(self.spool.retry)
+            return State.get_final(close=True)
+        if getattr(next_state, 'final', False):
+            self._settle(self.spool.ack)
+        elif state == 'CLOSED':
+            self._settle(self.spool.retry)
+        return next_state
+
+    def _settle(self, outcome):
+        if not self.settled:
+            self.settled = True
+            outcome(self.eid)
+
+
+class Spool(object):
+    r""" A persistent delivery queue stored in the ``path`` directory.
+
+    :param path: spool directory, created if missing.
+    :type path: :class:`str`
+    :param factory: factory delivering the messages, or ``None`` to only
+        store them.
+    :type factory: :class:`core.ConnectionFactory`
+    :param batch: number of enqueued messages that forces a commit.
+    :type batch: :class:`int`
+    :param interval: maximum seconds an enqueued message waits for a commit.
+    :type interval: :class:`float`
+    :param segment_size: size in bytes after which a new segment is started.
+    :type segment_size: :class:`int`
+    :param retry: seconds before sending again a failed message.
+    :type retry: :class:`float`
+    :param attempts: deliveries tried before giving a message up.
+    :type attempts: :class:`int`
+    :param expire: seconds after its enqueueing a message is given up.
+    :type expire: :class:`float`
+    :param on_fail: called with ``(eid, host, port, args, kwargs)`` of every
+        message given up.
+    :type on_fail: callable
+
+    >>> import tempfile, shutil
+    >>> path = tempfile.mkdtemp()
+    >>> s = Spool(path)
+    >>> s.enqueue('localhost', 25, source='me@work.it', targets=['you@work.it'])
+    0
+    >>> s.enqueue('localhost', 25, source='me@work.it', targets=['us@work.it'])
+    1
+    >>> s.commit(); s.ack(0); s.close()
+    >>> s = Spool(path)
+    >>> [(eid, kwargs['targets']) for eid, _, _, _, kwargs in s.pending()]
+    [(1, ['us@work.it'])]
+    >>> s.ack(1); s.close()
+    >>> sorted(os.listdir(path))
+    ['00000000.seg', 'index']
+
+    Messages that cannot be delivered are retried, then given up:
+
+    >>> from loop import run
+    >>> class Unreachable(object):
+    ...     outstate = dict
+    ...     def connect(self, automaton, host, port):
+    ...         raise IOError('unknown host {0}'.format(host))
+    >>> failed = []
+    >>> s = Spool(path, Unreachable(), retry=0, attempts=3,
+    ...     on_fail=lambda eid, host, port, args, kwargs: failed.append(host))
+    >>> s.enqueue('nowhere', 25, source='me@work.it')
+    2
+    >>> s.commit(); run(0.01)
+    >>> failed, list(s.pending())
+    (['nowhere'], [])
+    >>> s.close()
+
+    Messages given up while redriven do not disturb the iteration:
+
+    >>> s = Spool(path)
+    >>> for _ in range(4000):
+    ...     _ = s.enqueue('nowhere', 25)
+    >>> s.close(); del failed[:]
+    >>> s = Spool(path, Unreachable(), attempts=1,
+    ...     on_fail=lambda eid, host, port, args, kwargs: failed.append(eid))
+    >>> s.redrive()
+    >>> len(failed), list(s.pending())
+    (4000, [])
+    >>> s.close()
+
+    Messages left pending do not keep the index from being compacted:
+
+    >>> s = Spool(path)
+    >>> eids = [s.enqueue('localhost', 25) for _ in range(4096)]
+    >>> s.commit()
+    >>> index = os.path.join(path, 'index')
+    >>> size = os.path.getsize(index)
+    >>> for eid in eids[1:-1]:
+    ...     s.ack(eid)
+    >>> os.path.getsize(index) < size / 2
+    True
+    >>> s.close(); s = Spool(path)
+    >>> [eid for eid, _, _, _, _ in s.pending()] == [eids[0], eids[-1]]
+    True
+    >>> s.close(); shutil.rmtree(path)
+    """
+    def __init__(self, path, factory=None, **kwargs):
+        " Open or create a :class:`Spool`"
+        self.path = path
+        self.factory = factory
+        self.batch = kwargs.get('batch', 1024)
+        self.interval = kwargs.get('interval', 0.01)
+        self.segment_size = kwargs.get('segment_size', 64 * 1024 * 1024)
+        self.retry_delay = kwargs.get('retry', 60)
+        self.max_attempts = min(kwargs.get('attempts', 10), 255)
+        self.expire = kwargs.get('expire', 4 * 24 * 3600)
+        self.on_fail = kwargs.get('on_fail')
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._uncommitted = []
+        self._timer = None
+        self._iterating = 0
+        self._open_index()
+        self._live = {}
+        for eid, segment, _, _, _, status, _ in self._entries():
+            if status == PENDING:
+                self._live[segment] = self._live.get(segment, 0) + 1
+        if not self._positions:
+            self._reset()
+        self._segment = None
+        self._open_segment(max(self._segments() or [0]))
+
+    def _open_index(self):
+        """ Map the index and find the slot of every pending message. """
+        name = os.path.join(self.path, 'index')
+        self._index = open(name, 'a+b')
+        size = os.fstat(self._index.fileno()).st_size
+        if size < HEADER.size:
+            self._index.truncate(HEADER.size + ENTRY.size * 1024)
+            size = os.fstat(self._index.fileno()).st_size
+        self._map = mmap.mmap(self._index.fileno(), size)
+        magic, self.count, self._next = HEADER.unpack_from(self._map, 0)
+        if magic == '\0' * len(MAGIC):
+            HEADER.pack_into(self._map, 0, MAGIC, 0, 0)
+        elif magic != MAGIC:
+            raise SpoolError('{0} is not a spool index'.format(name))
+        self._slots = self.count
+        self._positions = {}
+        self._dead = 0
+        for slot, entry in enumerate(self._entries()):
+            if entry[5] == PENDING:
+                self._positions[entry[0]] = slot
+            else:
+                self._dead += 1
+
+    def _grow_index(self):
+        size = len(self._map) * 2
+        self._map.flush()
+        self._map.close()
+        self._index.truncate(size)
+        self._map = mmap.mmap(self._index.fileno(), size)
+
+    def _compact(self):
+        """ Rewrite the index with the pending messages only. """
+        slots = sorted(self._positions.values())
+        committed = sum(1 for slot in slots if slot < self.count)
+        name = os.path.join(self.path, 'index')
+        with open(name + '.tmp', 'wb') as f:
+            f.write(HEADER.pack(MAGIC, committed, self._next))
+            for slot in slots:
+                f.write(self._map[self._slot(slot):self._slot(slot + 1)])
+            f.truncate(HEADER.size + ENTRY.size * max(1024, 2 * len(slots)))
+            f.flush()
+            os.fsync(f.fileno())
+        self._map.close()
+        self._index.close()
+        os.rename(name + '.tmp', name)
+        self._open_index()
+        for slot in range(committed, len(slots)):
+            self._positions[ENTRY.unpack_from(self._map, self._slot(slot))[0]] = slot
+        self._slots = len(slots)
+
+    def _segments(self):
+        return sorted(
+            int(name[:-4]) for name in os.listdir(self.path)
+            if name.endswith('.seg')
+        )
+
+    def _segment_name(self, segment):
+        return os.path.join(self.path, '{0:08d}.seg'.format(segment))
+
+    def _open_segment(self, segment):
+        if self._segment is not None:
+            self._segment.close()
+        self._segment_id = segment
+        self._segment = open(self._segment_name(segment), 'ab')
+        self._segment.seek(0, os.SEEK_END)
+        self._offset = self._segment.tell()
+
+    @staticmethod
+    def _slot(slot):
+        return HEADER.size + slot * ENTRY.size
+
+    def _entries(self):
+        """ Iterate over the committed entries ``(eid, segment, offset,
+        length, created, status, attempts)``.
+        """
+        for slot in range(self.count):
+            yield ENTRY.unpack_from(self._map, self._slot(slot))
+
+    def _entry(self, eid):
+        try:
+            position = self._slot(self._positions[eid])
+        except KeyError:
+            raise SpoolError('No pending message {0}'.format(eid))
+        return position, list(ENTRY.unpack_from(self._map, position))
+
+    def _reset(self):
+        """ Drop every segment and empty the index. Only safe when no
+        message is pending.
+        """
+        for segment in self._segments():
+            os.remove(self._segment_name(segment))
+        self.count = self._slots = self._dead = 0
+        self._positions = {}
+        HEADER.pack_into(self._map, 0, MAGIC, 0, self._next)
+        self._map.flush()
+
+    def enqueue(self, host, port, *args, **kwargs):
+        """ Store a message for delivery to ``host``:``port``. Arguments are
+        passed to the factory's outcoming break point handler, so they must
+        be picklable.
+
+        :returns: the message id.
+        """
+        payload = pickle.dumps((host, port, args, kwargs), 2)
+        eid = self._next
+        self._next += 1
+        slot = self._slots
+        self._slots += 1
+        if self._slot(self._slots) > len(self._map):
+            self._grow_index()
+        if self._offset >= self.segment_size:
+            self._open_segment(self._segment_id + 1)
+        self._segment.write(
+            RECORD.pack(eid, len(payload), zlib.crc32(payload) & 0xffffffff)
+        )
+        self._segment.write(payload)
+        ENTRY.pack_into(
+            self._map, self._slot(slot), eid, self._segment_id, self._offset,
+            len(payload), int(time.time()), PENDING, 0
+        )
+        self._positions[eid] = slot
+        self._offset += RECORD.size + len(payload)
+        self._live[self._segment_id] = self._live.get(self._segment_id, 0) + 1
+        self._uncommitted.append(eid)
+        if len(self._uncommitted) >= self.batch:
+            self.commit()
+        elif self._timer is None:
+            self._timer = call_later(self.interval, self.commit)
+        return eid
+
+    def commit(self):
+        """ Make every enqueued message durable with a single ``fsync`` and
+        hand them to the factory.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._uncommitted:
+            return
+        self._segment.flush()
+        os.fsync(self._segment.fileno())
+        self.count = self._slots
+        HEADER.pack_into(self._map, 0, MAGIC, self.count, self._next)
+        self._map.flush()
+        committed, self._uncommitted = self._uncommitted, []
+        if self.factory is not None:
+            for eid in committed:
+                self.dispatch(eid)
+
+    def read(self, eid):
+        """ Return ``(host, port, args, kwargs)`` of the pending message
+        ``eid``.
+        """
+        _, (_, segment, offset, length, _, _, _) = self._entry(eid)
+        with open(self._segment_name(segment), 'rb') as f:
+            f.seek(offset)
+            return self._decode(eid, f.read(RECORD.size + length))
+
+    @staticmethod
+    def _decode(eid, record):
+        rid, length, crc = RECORD.unpack_from(record)
+        payload = record[RECORD.size:RECORD.size+length]
+        if rid != eid or zlib.crc32(payload) & 0xffffffff != crc:
+            raise SpoolError('Corrupted record {0}'.format(eid))
+        return pickle.loads(payload)
+
+    def pending(self):
+        """ Iterate over ``(eid, host, port, args, kwargs)`` of every
+        committed message not acknowledged yet.
+        """
+        maps = {}
+        self._iterating += 1
+        try:
+            for eid, segment, offset, length, _, status, _ in self._entries():
+                if status != PENDING:
+                    continue
+                if segment not in maps:
+                    with open(self._segment_name(segment), 'rb') as f:
+                        maps[segment] = mmap.mmap(
+                            f.fileno(), 0, access=mmap.ACCESS_READ
+                        )
+                record = maps[segment][offset:offset+RECORD.size+length]
+                try:
+                    host, port, args, kwargs = self._decode(eid, record)
+                except (SpoolError, struct.error) as e:
+                    LOGGER.error(e)
+                    continue
+                yield eid, host, port, args, kwargs
+        finally:
+            for segment_map in maps.values():
+                segment_map.close()
+            self._iterating -= 1
+            self._tidy()
+
+    def redrive(self):
+        """ Send again every pending message. Usually called at startup. """
+        for eid, host, port, args, kwargs in self.pending():
+            self._connect(eid, host, port, args, kwargs)
+
+    def dispatch(self, eid):
+        """ Hand message ``eid`` to the factory, if still pending. """
+        if eid not in self._positions:
+            return
+        try:
+            host, port, args, kwargs = self.read(eid)
+        except (SpoolError, struct.error, IOError) as e:
+            LOGGER.error('Cannot read {0}: {1}'.format(eid, e))
+            self._release(eid, FAILED)
+            return
+        self._connect(eid, host, port, args, kwargs)
+
+    def _connect(self, eid, host, port, args, kwargs):
+        try:
+            automaton = SpooledAutomaton(
+                self, eid, self.factory.outstate(*args, **kwargs)
+            )
+            self.factory.connect(automaton, host, port)
+        except Exception as e:
+            LOGGER.warning('Cannot dispatch {0}: {1!r}'.format(eid, e))
+            self.retry(eid)
+
+    def retry(self, eid):
+        """ Schedule a new delivery of message ``eid``, or give it up once
+        out of attempts or expired.
+        """
+        if eid not in self._positions:
+            return
+        position, entry = self._entry(eid)
+        entry[6] += 1
+        ENTRY.pack_into(self._map, position, *entry)
+        if entry[6] >= self.max_attempts or time.time() - entry[4] >= self.expire:
+            LOGGER.error('Giving up {0} after {1} attempts'.format(
+                eid, entry[6]
+            ))
+            self.fail(eid)
+            return
+        LOGGER.warning('Delivery of {0} failed, retrying in {1}s'.format(
+            eid, self.retry_delay
+        ))
+        call_later(self.retry_delay, self.dispatch, eid)
+
+    def fail(self, eid):
+        """ Give message ``eid`` up and pass it to ``on_fail``. """
+        if eid not in self._positions:
+            return
+        if self.on_fail is not None:
+            try:
+                message = self.read(eid)
+            except (SpoolError, struct.error, IOError) as e:
+                LOGGER.error('Cannot read {0}: {1}'.format(eid, e))
+            else:
+                self.on_fail(eid, *message)
+        self._release(eid, FAILED)
+
+    def ack(self, eid):
+        """ Mark message ``eid`` as delivered. Segments left without pending
+        messages are removed.
+        """
+        if eid in self._positions:
+            self._release(eid, DONE)
+
+    def _release(self, eid, outcome):
+        """ Mark message ``eid`` with ``outcome`` and remove its segment when
+        left without pending messages.
+        """
+        position, entry = self._entry(eid)
+        segment, entry[5] = entry[1], outcome
+        ENTRY.pack_into(self._map, position, *entry)
+        if self._positions.pop(eid) < self.count:
+            self._dead += 1
+        self._live[segment] -= 1
+        if not self._live[segment]:
+            del self._live[segment]
+            if segment != self._segment_id:
+                os.remove(self._segment_name(segment))
+        self._tidy()
+
+    def _tidy(self):
+        """ Reset the spool once empty, or compact the index once released
+        entries fill half of it. Both move entries around, so they wait for
+        :meth:`pending` iterations to end.
+        """
+        if self._iterating:
+            return
+        if not self._live:
+            if self.count or self._slots:
+                self._reset()
+                self._open_segment(0)
+        elif self._dead >= 1024 and 2 * self._dead >= self._slots:
+            self._compact()
+
+    def close(self):
+        """ Commit pending work and close the spool files. """
+        self.commit()
+        self._map.flush()
+        self._map.close()
+        self._index.close()
+        self._segment.close()
@@ -5,10 +5,28 @@ __all__ = (
     'Automaton',
 )
 
-class State(namedtuple('State', ('push', 'terminator', 'close', 'final'))):
+class State(namedtuple('State', (
+    'push', 'terminator', 'close', 'final', 'maxline', 'maxbuffer'
+))):
+    """ What a break point returns: data to ``push``, the next
+    ``terminator``, whether to ``close`` and whether the automaton is
+    ``final``.
+
+    Along with a new terminator, ``maxline`` bounds the bytes buffered
+    waiting for a string terminator and ``maxbuffer`` those waiting for an
+    integer or ``None`` one. ``None`` keeps the defaults of
+    :class:`core.Connection`.
+    """
+    def __new__(cls, push, terminator, close, final, maxline=None,
+            maxbuffer=None):
+        return super(State, cls).__new__(
+            cls, push, terminator, close, final, maxline, maxbuffer
+        )
+
     @classmethod
-    def get_push(cls, push=None, terminator=None):
-        return cls(push, terminator, False, False)
+    def get_push(cls, push=None, terminator=None, maxline=None,
+            maxbuffer=None):
+        return cls(push, terminator, False, False, maxline, maxbuffer)
 
     @classmethod
     def get_final(cls, push=None, close=False):
@@ -25,4 +43,13 @@ class Automaton(object):
         raise NotImplementedError
 
     def error(self, data):
-        raise NotImplementedError
+        return State.get_final(close=True)
+
+    def pause(self, data):
+        return State.get_push()
+
+    def resume(self, data):
+        return State.get_push()
+
+    def closed(self, data):
+        return State.get_push()